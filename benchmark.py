@@ -0,0 +1,283 @@
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+import importlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import generate_test_data
+
+try:
+    import psutil
+except ImportError:  # optional: RSS is read from /proc or getrusage without it
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# ---------- Configuration ----------
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test1 (1).py')   # Consolidation script under test
+bench_root = r'C:\Users\AD46100\Desktop\benchmark'                      # Synthetic source tree, outputs and results go here
+generate_data = True                                                    # Build the synthetic tree first (skipped when it exists)
+results_file = None                                                     # None writes results_<timestamp>.json into bench_root
+compare_file = None                                                     # Earlier results file to compare against
+keep_output = False                                                     # Keep each configuration's consolidated parts
+rss_sample_seconds = 0.05                                               # How often the peak RSS sampler looks at memory
+
+# Each configuration runs in a fresh process with these overrides of the script's configuration
+CONFIGURATIONS = [
+    {'name': 'baseline', 'options': {}},
+    {'name': 'read_workers_4', 'options': {'read_workers': 4}},
+    {'name': 'pyarrow_engine', 'options': {'parser_engine': 'pyarrow'}},
+    {'name': 'gzip_parts', 'options': {'output_compression': 'gzip'}},
+    {'name': 'zstd_parts', 'options': {'output_compression': 'zstd'}},
+    {'name': 'parquet_parts', 'options': {'output_format': 'parquet'}},
+    {'name': 'workers_2', 'options': {'workers': 2}},
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the consolidation stages on a synthetic source tree.")
+    parser.add_argument('--bench-root', dest='bench_root', help="Folder for the synthetic tree, outputs and results")
+    parser.add_argument('--script', dest='script_path', help="Consolidation script to benchmark")
+    parser.add_argument('--results', dest='results_file', help="Results JSON file to write")
+    parser.add_argument('--compare', dest='compare_file', help="Earlier results JSON file to compare against")
+    parser.add_argument('--configs', dest='config_names', help="Comma separated configuration names to run")
+    parser.add_argument('--no-generate', dest='generate_data', action='store_false', default=None, help="Use the existing tree in bench-root")
+    parser.add_argument('--keep-output', dest='keep_output', action='store_true', default=None, help="Keep the consolidated parts")
+    parser.add_argument('--rows', dest='rows_per_file', type=int, help="Data rows per generated file")
+    parser.add_argument('--months', dest='months', type=int, help="Number of generated monthly folders")
+    parser.add_argument('--prefixes', dest='prefix_count', type=int, help="Number of generated prefixes")
+    return parser.parse_args()
+
+
+def get_source_root():
+    return os.path.join(bench_root, 'source')
+
+
+def get_prefix_file():
+    return os.path.join(bench_root, 'prefix_file.xlsx')
+
+
+def get_module_dir():
+    return os.path.join(bench_root, 'module')
+
+
+def copy_archival():
+    # The script name has spaces and brackets, so a copy under an importable name is benchmarked.
+    # Worker processes started by the script (workers > 1) then find its functions by module name.
+    os.makedirs(get_module_dir(), exist_ok=True)
+    shutil.copyfile(script_path, os.path.join(get_module_dir(), 'archival.py'))
+
+
+def load_archival():
+    for path in (get_module_dir(), os.path.dirname(os.path.abspath(script_path))):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return importlib.import_module('archival')
+
+
+def get_rss_bytes():
+    # Current resident memory of this process and any worker processes it started
+    if psutil is not None:
+        process = psutil.Process()
+        return process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # already a peak, in KB on Linux
+    return None
+
+
+class PeakRssSampler:
+    # Samples RSS on a background thread for the duration of one stage
+    def __init__(self):
+        self.peak = get_rss_bytes()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        rss = get_rss_bytes()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def run(self):
+        while not self.stop_event.wait(rss_sample_seconds):
+            self.sample()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+def time_stage(stages, name, func):
+    # func returns (rows, bytes) processed by the stage
+    with PeakRssSampler() as sampler:
+        start = time.perf_counter()
+        rows, data_bytes = func()
+        wall = time.perf_counter() - start
+    stages[name] = {
+        'wall_s': round(wall, 3),
+        'rows': rows,
+        'mb': round(data_bytes / (1024*1024), 2),
+        'rows_per_s': round(rows / wall, 1) if wall and rows else None,
+        'mb_per_s': round(data_bytes / (1024*1024) / wall, 2) if wall and data_bytes else None,
+        'peak_rss_mb': round(sampler.peak / (1024*1024), 1) if sampler.peak is not None else None,
+    }
+    return stages[name]
+
+
+def run_configuration(config, bench_options):
+    # Runs in its own process so peak RSS and module level caches of one configuration do not leak into the next
+    globals().update(bench_options)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s - %(message)s")
+    archival = load_archival()
+    output_dir = os.path.join(bench_root, 'output', config['name'])
+    shutil.rmtree(output_dir, ignore_errors=True)
+    archival.apply_options(dict(config['options'], local_source_prefix=get_source_root(), local_prefix_file=get_prefix_file(),
+                                local_output_dir=output_dir, save_source_index=False, incremental_runs=False))
+    os.makedirs(output_dir, exist_ok=True)
+    stages = {}
+    state = {}
+
+    def index_stage():
+        state['prefixes'] = archival.read_prefix_sheet(archival.local_prefix_file)
+        state['folders'] = archival.list_monthly_folders(archival.local_source_prefix)
+        source_index = archival.build_source_index(state['folders'])
+        state['matches'] = [archival.find_prefix_files(source_index, prefix) for prefix in state['prefixes']]
+        state['source_bytes'] = sum(match['file_size'] for matches in state['matches'] for match in matches)
+        return 0, state['source_bytes']  # files are listed, not rows, so no rows/s for this stage
+
+    def read_stage():
+        rows = 0
+        for prefix, matches in zip(state['prefixes'], state['matches']):
+            prefix_files, expected_cols, all_columns = archival.plan_prefix_schema(prefix, state['folders'], matches)
+            if archival.read_workers > 1:
+                file_chunks = archival.read_files_concurrently(prefix_files)
+            else:
+                file_chunks = ((prefix_file, archival.read_prefix_file(prefix_file)) for prefix_file in prefix_files)
+            for prefix_file, chunks in file_chunks:
+                for chunk in chunks:
+                    if 'sample' not in state:
+                        state['sample'] = (chunk, expected_cols)  # reused by the write stage
+                    rows += len(chunk)
+        state['rows'] = rows
+        return rows, state['source_bytes']
+
+    def write_stage():
+        # Writes the first chunk read over and over, up to the row count of the source, so only the writer is timed
+        chunk, expected_cols = state['sample']
+        repeats = max(state['rows'] // len(chunk), 1)
+        parts = archival.save_chunks((chunk for _ in range(repeats)), archival.get_output_filename('write_stage'), expected_cols)
+        return repeats * len(chunk), sum(part['file_bytes'] for part in parts)
+
+    def consolidate_stage():
+        archival.consolidate_files()
+        return state['rows'], state['source_bytes']
+
+    time_stage(stages, 'index', index_stage)
+    time_stage(stages, 'read', read_stage)
+    if 'sample' in state:
+        time_stage(stages, 'write', write_stage)
+    time_stage(stages, 'consolidate', consolidate_stage)
+    if not keep_output:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {'name': config['name'], 'options': config['options'], 'stages': stages}
+
+
+def get_version():
+    # Identifies the code measured, so results of different versions can be told apart
+    with open(script_path, 'rb') as f:
+        script_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(script_path),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'git_commit': commit, 'script_sha256': script_hash}
+
+
+def compare_results(old_results, new_results):
+    # Wall time change per configuration and stage; positive is slower
+    old_configs = {config['name']: config for config in old_results['configurations']}
+    for config in new_results['configurations']:
+        old_config = old_configs.get(config['name'])
+        if old_config is None:
+            continue
+        for stage, metrics in config['stages'].items():
+            old_metrics = old_config['stages'].get(stage)
+            if not old_metrics or not old_metrics['wall_s']:
+                continue
+            change = (metrics['wall_s'] - old_metrics['wall_s']) / old_metrics['wall_s'] * 100
+            rss_change = ''
+            if metrics['peak_rss_mb'] is not None and old_metrics['peak_rss_mb'] is not None:
+                rss_change = f" | peak RSS {old_metrics['peak_rss_mb']} -> {metrics['peak_rss_mb']} MB"
+            print(f"{config['name']:<16} {stage:<12} {old_metrics['wall_s']:>8.2f}s -> {metrics['wall_s']:>8.2f}s ({change:+.1f}%){rss_change}")
+
+
+def run_benchmark(config_names=None):
+    if generate_data and not os.path.isdir(get_source_root()):
+        generate_test_data.apply_options({'output_root': get_source_root(), 'prefix_file': get_prefix_file()})
+        generate_test_data.generate_tree()
+    copy_archival()
+    configs = [config for config in CONFIGURATIONS if config_names is None or config['name'] in config_names]
+    bench_options = {'bench_root': bench_root, 'script_path': script_path, 'keep_output': keep_output}
+    results = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'version': get_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'configurations': [],
+    }
+    for config in configs:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            result = pool.submit(run_configuration, config, bench_options).result()
+        results['configurations'].append(result)
+        for stage, metrics in result['stages'].items():
+            print(f"{config['name']:<16} {stage:<12} {metrics['wall_s']:>8.2f}s | {metrics['rows_per_s'] or 0:>12,.0f} rows/s | "
+                  f"{metrics['mb_per_s'] or 0:>8.2f} MB/s | peak RSS {metrics['peak_rss_mb']} MB")
+
+    results_path = results_file or os.path.join(bench_root, f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(results_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to: {results_path}")
+    if compare_file:
+        with open(compare_file, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+    return results
+
+
+# ---------- Run ----------
+if __name__ == '__main__':
+    options = vars(parse_args())
+    config_names = options.pop('config_names')
+    for name in ('rows_per_file', 'months', 'prefix_count'):
+        value = options.pop(name)
+        if value is not None:
+            setattr(generate_test_data, name, value)
+    for name, value in options.items():
+        if value is not None:
+            globals()[name] = value
+    run_benchmark(config_names.split(',') if config_names else None)
@@ -0,0 +1,137 @@
+
+import os
+import random
+import argparse
+import calendar
+
+import pandas as pd
+
+# ---------- Configuration ----------
+output_root = r'C:\Users\AD46100\Downloads\synthetic'                   # Root folder the monthly folders are created in
+prefix_file = None                                                      # Excel prefix sheet to write, None writes <output_root>_prefix_file.xlsx
+start_period = '202401'                                                 # First monthly folder (YYYYMM)
+months = 12                                                             # Number of monthly folders
+prefix_count = 3                                                        # Prefixes generated, the first is INP_Allowance_Metrics
+files_per_month = 1                                                     # Files per prefix per month
+rows_per_file = 100000                                                  # Data rows per file
+column_drift = 0.2                                                      # Chance a file drops a column or adds an extra one
+cp1252_share = 0.1                                                      # Share of files written in cp1252 with accented text
+subfolder_share = 0.3                                                   # Share of files placed in a sub folder of the month
+seed = 1                                                                # Same seed, same tree
+
+BASE_COLUMNS = ['WWID', 'Geo_ID', 'Period', 'Allowance_Type', 'Allowance_Value', 'Taxable',
+                'Monthly_Proration_Flag', 'Reporting_Flag', 'PAYMENT_FREQUENCY']
+EXTRA_COLUMNS = ['Cost_Center', 'Currency', 'Comments']
+ALLOWANCE_TYPES = ['P1 Coverage Payment', 'P2 Coverage Payment', 'P3 Coverage Payment', 'Relocation Allowance']
+ACCENTED_TYPES = ['Prime de d\u00e9m\u00e9nagement', 'Indemnit\u00e9 de logement', 'Zulage f\u00fcr B\u00fcro']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build a synthetic monthly source tree for benchmarks.")
+    parser.add_argument('--output-root', dest='output_root', help="Root folder the monthly folders are created in")
+    parser.add_argument('--prefix-file', dest='prefix_file', help="Excel prefix sheet to write")
+    parser.add_argument('--start-period', dest='start_period', help="First monthly folder (YYYYMM)")
+    parser.add_argument('--months', dest='months', type=int, help="Number of monthly folders")
+    parser.add_argument('--prefixes', dest='prefix_count', type=int, help="Number of prefixes")
+    parser.add_argument('--files-per-month', dest='files_per_month', type=int, help="Files per prefix per month")
+    parser.add_argument('--rows', dest='rows_per_file', type=int, help="Data rows per file")
+    parser.add_argument('--column-drift', dest='column_drift', type=float, help="Chance a file drops or adds a column")
+    parser.add_argument('--cp1252-share', dest='cp1252_share', type=float, help="Share of files written in cp1252")
+    parser.add_argument('--seed', dest='seed', type=int, help="Random seed")
+    return parser.parse_args()
+
+
+def apply_options(options):
+    for name, value in options.items():
+        if value is not None:
+            globals()[name] = value
+
+
+def get_periods():
+    year, month = int(start_period[:4]), int(start_period[4:])
+    periods = []
+    for _ in range(months):
+        periods.append(f"{year}{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def get_prefixes():
+    return ['INP_Allowance_Metrics'] + [f"INP_Extract_{i:02d}" for i in range(1, prefix_count)]
+
+
+def get_file_columns(rng):
+    # Most files carry the base layout; drifted files lose one column or gain one of the extra columns
+    columns = list(BASE_COLUMNS)
+    if rng.random() < column_drift:
+        if rng.random() < 0.5:
+            columns.remove(rng.choice(columns[3:]))
+        else:
+            columns.append(rng.choice(EXTRA_COLUMNS))
+    return columns
+
+
+def make_row(rng, period, columns, accented):
+    geo_id = f"T{rng.randint(100, 999)}-TRM"
+    allowance_type = rng.choice(ACCENTED_TYPES if accented else ALLOWANCE_TYPES)
+    values = {
+        'WWID': str(rng.randint(1000000, 999999999)),
+        'Geo_ID': geo_id,
+        'Period': period,
+        'Allowance_Type': f"{allowance_type}-{geo_id}",
+        'Allowance_Value': str(rng.choice([500, 1000, 2500, 5000])),
+        'Taxable': rng.choice(['', 'Y', 'N']),
+        'Monthly_Proration_Flag': rng.choice('YN'),
+        'Reporting_Flag': rng.choice('YN'),
+        'PAYMENT_FREQUENCY': rng.choice(['', 'M', 'Q']),
+        'Cost_Center': str(rng.randint(10000, 99999)),
+        'Currency': rng.choice(['USD', 'EUR', 'GBP']),
+        'Comments': '',
+    }
+    return '|'.join(values[col] for col in columns)
+
+
+def write_file(file_path, rng, period, columns, encoding):
+    accented = encoding == 'cp1252'
+    with open(file_path, 'w', encoding=encoding, newline='') as f:
+        f.write('|'.join(columns) + '\n')
+        batch = []
+        for _ in range(rows_per_file):
+            batch.append(make_row(rng, period, columns, accented))
+            if len(batch) == 10000:
+                f.write('\n'.join(batch) + '\n')
+                batch = []
+        if batch:
+            f.write('\n'.join(batch) + '\n')
+
+
+def generate_tree():
+    rng = random.Random(seed)
+    prefixes = get_prefixes()
+    total_files = 0
+    total_bytes = 0
+    for period in get_periods():
+        year, month = int(period[:4]), int(period[4:])
+        last_day = calendar.monthrange(year, month)[1]
+        for prefix in prefixes:
+            for i in range(files_per_month):
+                folder = os.path.join(output_root, period)
+                if rng.random() < subfolder_share:
+                    folder = os.path.join(folder, 'extracts')
+                os.makedirs(folder, exist_ok=True)
+                day = max(last_day - i, 1)
+                file_path = os.path.join(folder, f"{prefix}_{period}{day:02d}.txt")
+                encoding = 'cp1252' if rng.random() < cp1252_share else 'utf-8'
+                write_file(file_path, rng, period, get_file_columns(rng), encoding)
+                total_files += 1
+                total_bytes += os.path.getsize(file_path)
+    sheet_path = prefix_file or output_root.rstrip('\\/') + '_prefix_file.xlsx'
+    pd.DataFrame({'prefix': prefixes}).to_excel(sheet_path, index=False)
+    print(f"Generated {total_files} files, {total_bytes / (1024*1024):.1f} MB under {output_root}; prefix sheet {sheet_path}")
+    return {'files': total_files, 'bytes': total_bytes, 'prefix_file': sheet_path}
+
+
+# ---------- Run ----------
+if __name__ == '__main__':
+    apply_options(vars(parse_args()))
+    generate_tree()
@@ -0,0 +1,171 @@
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+
+import pandas as pd
+
+import generate_test_data
+
+# ---------- Configuration ----------
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test1 (1).py')   # Consolidation script under test
+work_root = r'C:\Users\AD46100\Desktop\queue_test'                      # Source tree, output and queue folders go here
+worker_count = 3                                                        # Queue workers started at once
+lease_seconds = 3                                                       # Short, so the killed worker's lease is taken over quickly
+rows_per_file = 200000                                                  # Large enough that a worker is killed half way through a prefix
+timeout_seconds = 900                                                   # A worker still running after this fails the test
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Kill a queue worker half way through a prefix and check another takes it over.")
+    parser.add_argument('--work-root', dest='work_root', help="Folder for the source tree, output and queue")
+    parser.add_argument('--script', dest='script_path', help="Consolidation script to test")
+    parser.add_argument('--workers', dest='worker_count', type=int, help="Queue workers started at once")
+    parser.add_argument('--lease-seconds', dest='lease_seconds', type=float, help="Lease timeout given to the workers")
+    parser.add_argument('--rows', dest='rows_per_file', type=int, help="Data rows per generated file")
+    return parser.parse_args()
+
+
+def get_source_root():
+    return os.path.join(work_root, 'source')
+
+
+def get_output_dir():
+    return os.path.join(work_root, 'output')
+
+
+def get_queue_dir():
+    return os.path.join(work_root, 'queue')
+
+
+def start_workers():
+    command = [sys.executable, script_path, '--source', get_source_root(), '--prefix-file', os.path.join(work_root, 'prefix_file.xlsx'),
+               '--output-dir', get_output_dir(), '--queue', '--queue-dir', get_queue_dir(), '--queue-run', 'takeover',
+               '--lease-seconds', str(lease_seconds)]
+    environment = dict(os.environ, TERM='dumb')
+    return [subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment)
+            for _ in range(worker_count)]
+
+
+def read_manifest(prefix):
+    # Latest output file of the prefix and the files recorded into it
+    output_file, files = None, []
+    manifest_path = os.path.join(get_output_dir(), 'manifest', f"{prefix}.jsonl")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['record_type'] == 'output':
+                    output_file, files = record['output_file'], []
+                elif record['record_type'] == 'file':
+                    files.append(record['file_location'])
+    return output_file, files
+
+
+def kill_mid_prefix(workers, prefix_files):
+    # Kills the worker holding a lease once its prefix has some files but not all of them in the manifest
+    pids = {worker.pid: worker for worker in workers}
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline and any(worker.poll() is None for worker in workers):
+        for lease_path in glob.glob(os.path.join(get_queue_dir(), 'takeover', '*.lease')):
+            prefix = os.path.basename(lease_path)[:-len('.lease')]
+            try:
+                with open(lease_path, 'r', encoding='utf-8') as f:
+                    pid = int(json.load(f)['worker'].rsplit('-', 1)[1])
+            except (OSError, ValueError, KeyError):
+                continue
+            if pid in pids and 0 < len(read_manifest(prefix)[1]) < len(prefix_files[prefix]):
+                pids[pid].kill()  # SIGKILL, or TerminateProcess on Windows: no chance to clean up either way
+                pids[pid].wait()
+                return prefix
+        time.sleep(0.05)
+    return None
+
+
+def hash_file(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def count_rows(file_path):
+    with open(file_path, 'rb') as f:
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1024*1024), b'')) - 1
+
+
+def check_output(prefix_files, killed_prefix):
+    failures = []
+    if killed_prefix is None:
+        failures.append("No worker was killed half way through a prefix")
+    for lease_path in glob.glob(os.path.join(get_queue_dir(), 'takeover', '*.lease')):
+        if not lease_path.endswith('merge.lease'):
+            failures.append(f"Lease left behind: {lease_path}")
+    master_logs = sorted(glob.glob(os.path.join(get_output_dir(), 'master_log_*.csv')))
+    summary_logs = sorted(glob.glob(os.path.join(get_output_dir(), 'summary_log_*.csv')))
+    if len(master_logs) != 1 or len(summary_logs) != 1:
+        return failures + [f"Expected one merged master and summary log, found {len(master_logs)} and {len(summary_logs)}"]
+    master_log = pd.read_csv(master_logs[0], sep='|')
+    summary_log = pd.read_csv(summary_logs[0], sep='|').set_index('prefix')
+    for prefix, files in prefix_files.items():
+        source_rows = sum(count_rows(file_path) for file_path in files)
+        output_file, _ = read_manifest(prefix)
+        parts = sorted(glob.glob(output_file.replace('.csv', '_part*.csv')))
+        part_rows = sum(count_rows(part) for part in parts)
+        for part in parts:
+            with open(part + '.sha256', 'r', encoding='utf-8') as f:
+                expected = f.read().split()[0]
+            if hash_file(part) != expected:
+                failures.append(f"{part} does not match its .sha256")
+        logged = master_log.loc[master_log['file_location'].isin(files), 'file_location'].tolist()
+        summary_rows = summary_log.loc[prefix, 'total_rows'] if prefix in summary_log.index else None
+        print(f"{prefix:<24} source {source_rows:>9} | parts {part_rows:>9} | summary {summary_rows} | "
+              f"master log {len(logged)}/{len(files)} files{' | taken over' if prefix == killed_prefix else ''}")
+        if part_rows != source_rows:
+            failures.append(f"{prefix}: {part_rows} rows in the parts for {source_rows} source rows")
+        if summary_rows != source_rows:
+            failures.append(f"{prefix}: summary total_rows {summary_rows} for {source_rows} source rows")
+        if sorted(logged) != sorted(files):
+            failures.append(f"{prefix}: master log lists {len(logged)} of {len(files)} files, or some twice")
+    return failures
+
+
+def run_takeover_test():
+    shutil.rmtree(work_root, ignore_errors=True)
+    generate_test_data.apply_options({'output_root': get_source_root(), 'prefix_file': os.path.join(work_root, 'prefix_file.xlsx'),
+                                      'months': 3, 'prefix_count': 3, 'rows_per_file': rows_per_file, 'column_drift': 0})
+    generate_test_data.generate_tree()
+    prefix_files = {prefix: sorted(glob.glob(os.path.join(get_source_root(), '*', '**', f"{prefix}_*"), recursive=True))
+                    for prefix in generate_test_data.get_prefixes()}
+    workers = start_workers()
+    try:
+        killed_prefix = kill_mid_prefix(workers, prefix_files)
+        for worker in workers:
+            worker.wait(timeout=timeout_seconds)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+    failures = check_output(prefix_files, killed_prefix)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    print("Queue takeover test passed" if not failures else f"Queue takeover test failed ({len(failures)} problems)")
+    return not failures
+
+
+# ---------- Run ----------
+if __name__ == '__main__':
+    for name, value in vars(parse_args()).items():
+        if value is not None:
+            globals()[name] = value
+    sys.exit(0 if run_takeover_test() else 1)
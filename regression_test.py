@@ -0,0 +1,94 @@
+
+import os
+import sys
+import tempfile
+import importlib.util
+
+import pandas as pd
+
+# ---------- Configuration ----------
+script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test1 (1).py')   # Consolidation script under test
+
+
+def load_archival():
+    # The script name has spaces and brackets, so it is loaded from its path under an importable name
+    spec = importlib.util.spec_from_file_location('archival', script_path)
+    archival = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(archival)
+    return archival
+
+
+def check_dedup_after_duplicate_chunk(archival):
+    # A chunk whose rows were all seen before must not stop the rows of the next chunk being kept
+    with tempfile.TemporaryDirectory() as temp_dir:
+        key_set = archival.RowKeySet(['WWID', 'Period'], os.path.join(temp_dir, 'keys.sqlite'))
+        first = pd.DataFrame({'WWID': [1, 2, 3], 'Period': ['202401'] * 3})
+        new = pd.DataFrame({'WWID': [4, 5], 'Period': ['202402'] * 2})
+        kept = [len(key_set.drop_seen(first)), len(key_set.drop_seen(first)), len(key_set.drop_seen(new))]
+        key_set.close()
+    if kept != [3, 0, 2]:
+        return [f"RowKeySet kept {kept} rows for a new, an all duplicate and a new chunk, expected [3, 0, 2]"]
+    return []
+
+
+class FakeS3Client:
+    # Just the multipart upload calls of an S3 client; an object only exists once its upload is completed
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads) + len(self.objects) + 1)
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        data = self.uploads.pop(UploadId)
+        self.objects[f"s3://{Bucket}/{Key}"] = b''.join(data[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+
+def check_no_s3_part_after_failure(archival):
+    # A part cut off by an error half way through the chunks must not be published under its final key
+    failures = []
+    client = FakeS3Client()
+    archival.get_s3 = lambda: client
+    chunk = pd.DataFrame({'WWID': [str(i) for i in range(1000)], 'period': '202401'})
+
+    def failing_chunks():
+        yield chunk
+        raise RuntimeError("read failed")
+
+    for options in ({'output_format': 'csv', 'output_compression': 'none'}, {'output_format': 'csv', 'output_compression': 'gzip'},
+                    {'output_format': 'parquet', 'output_compression': 'none'}):
+        archival.apply_options(options)
+        try:
+            archival.save_chunks(failing_chunks(), f"s3://out/consolidated_P{archival.get_output_extension()}", ['WWID', 'period'])
+            failures.append(f"save_chunks did not raise with {options}")
+        except RuntimeError:
+            pass
+        if client.objects or client.uploads:
+            failures.append(f"S3 objects {sorted(client.objects)} and {len(client.uploads)} open uploads left after a failure with {options}")
+        client.objects, client.uploads = {}, {}
+    return failures
+
+
+def run_regression_tests():
+    archival = load_archival()
+    failures = check_dedup_after_duplicate_chunk(archival)
+    failures += check_no_s3_part_after_failure(archival)
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    print("Regression tests passed" if not failures else f"Regression tests failed ({len(failures)} problems)")
+    return not failures
+
+
+# ---------- Run ----------
+if __name__ == '__main__':
+    sys.exit(0 if run_regression_tests() else 1)
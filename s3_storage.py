@@ -0,0 +1,184 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import boto3
+    from botocore.config import Config
+except ImportError:  # only needed when a source or output path starts with s3://
+    boto3 = None
+    Config = None
+
+
+MIN_MULTIPART_PART_BYTES = 5*1024*1024                                  # S3 minimum for every part but the last
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def is_s3_path(path):
+    return str(path).lower().startswith('s3://')
+
+
+def split_s3_path(path):
+    bucket, _, key = str(path)[5:].partition('/')
+    return bucket, key
+
+
+def join_path(base, *names):
+    # os.path.join would put backslashes into S3 keys on Windows
+    return '/'.join([base.rstrip('/')] + [name.strip('/') for name in names])
+
+
+def get_s3_client(endpoint_url=None, max_connections=10):
+    # One client per endpoint and process; boto3 clients are thread safe and share the connection pool
+    if boto3 is None:
+        raise RuntimeError("s3:// paths need boto3 installed")
+    client_key = (endpoint_url, max_connections)
+    with _clients_lock:
+        if client_key not in _clients:
+            config = Config(max_pool_connections=max_connections, retries={'max_attempts': 5, 'mode': 'standard'})
+            _clients[client_key] = boto3.session.Session().client('s3', endpoint_url=endpoint_url, config=config)
+        return _clients[client_key]
+
+
+def list_s3_folders(client, root):
+    # Immediate "sub folders" of root, using the delimiter so only common prefixes come back
+    bucket, key = split_s3_path(root)
+    prefix = key.rstrip('/') + '/' if key else ''
+    folders = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            name = common_prefix['Prefix'][len(prefix):].rstrip('/')
+            folders.append((name, f"s3://{bucket}/{common_prefix['Prefix'].rstrip('/')}"))
+    return folders
+
+
+def list_s3_files(client, folder):
+    # All objects under folder (like os.walk), filtered server side by the folder prefix, 1000 keys per request.
+    # Returns (name, path, size, mtime in ns) per object.
+    bucket, key = split_s3_path(folder)
+    prefix = key.rstrip('/') + '/' if key else ''
+    files = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue  # folder placeholder objects
+            name = obj['Key'].rsplit('/', 1)[-1]
+            mtime = int(obj['LastModified'].timestamp() * 1_000_000_000)
+            files.append((name, f"s3://{bucket}/{obj['Key']}", obj['Size'], mtime))
+    return files
+
+
+def get_s3_size(client, path):
+    bucket, key = split_s3_path(path)
+    try:
+        return client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    except client.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def has_multipart_upload(client, path):
+    # An upload of path started but never completed or aborted, as left behind by a process that died writing it
+    bucket, key = split_s3_path(path)
+    uploads = client.list_multipart_uploads(Bucket=bucket, Prefix=key).get('Uploads', [])
+    return any(upload['Key'] == key for upload in uploads)
+
+
+class S3ObjectReader(io.RawIOBase):
+    # Streams an object (or a byte range of it) through a single GET, for use under io.BufferedReader
+    def __init__(self, client, path, length=None, start=0):
+        bucket, key = split_s3_path(path)
+        request = {'Bucket': bucket, 'Key': key}
+        if length is not None:
+            request['Range'] = f"bytes={start}-{start + length - 1}"
+        elif start:
+            request['Range'] = f"bytes={start}-"
+        try:
+            self.body = client.get_object(**request)['Body']
+        except client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            self.body = None  # a range request on an empty object
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.body is None:
+            return 0
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.body is not None:
+            self.body.close()
+        super().close()
+
+
+class S3MultipartWriter(io.RawIOBase):
+    # Streams writes into a multipart upload, so parts go to S3 as they are produced without local staging.
+    # Up to `concurrency` parts upload at once; writers wait when that many buffers are in flight.
+    # The object only appears once close() completes the upload, so a crash never leaves a half written object.
+    def __init__(self, client, path, part_bytes=8*1024*1024, concurrency=4):
+        self.client = client
+        self.bucket, self.key = split_s3_path(path)
+        self.part_bytes = max(part_bytes, MIN_MULTIPART_PART_BYTES)
+        self.upload_id = client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.in_flight = threading.BoundedSemaphore(concurrency)
+        self.futures = []
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def upload_part(self, part_number, data):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                               PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            self.in_flight.release()
+
+    def submit_part(self, data):
+        self.in_flight.acquire()
+        self.futures.append(self.executor.submit(self.upload_part, len(self.futures) + 1, data))
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_bytes:
+            self.submit_part(bytes(self.buffer[:self.part_bytes]))
+            del self.buffer[:self.part_bytes]
+        return len(data)
+
+    def abort(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or not self.futures:
+                self.submit_part(bytes(self.buffer))  # the last part may be smaller than the minimum
+                self.buffer = bytearray()
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        self.executor.shutdown(wait=True)
+        super().close()
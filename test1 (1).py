@@ -1,238 +1,2777 @@
-
-import pandas as pd
-import os
-import logging
-from datetime import datetime
-import time
-import io
-
-# clear terminal
-os.system('cls' if os.name == 'nt' else 'clear')
-
-# ---------- Configuration ----------
-MAX_FILE_SIZE_BYTES = 20*1024*1024*1024                                 #20GB Hard Limit
-local_source_prefix = r'C:\Users\AD46100\Downloads\2024'                # Root folder containing monthly folders
-local_prefix_file = r'C:\Users\AD46100\Desktop\prefix_file.xlsx'
-local_output_dir = r'C:\Users\AD46100\Desktop\output'
-dry_run = False                                                         # Set True to skip actual saving
-
-
-
-# ---------- Logging ----------
-os.makedirs(local_output_dir,exist_ok=True)
-log_file_path = os.path.join(local_output_dir,f"run_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file_path),
-        logging.StreamHandler()
-    ]
-)
-
-# logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
-logging.info("-------------Program Started-----------------")
-process_start = datetime.now()
-
-
-def get_output_filename(prefix):
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"consolidated_{prefix}_{timestamp}.csv"
-    return os.path.join(local_output_dir, filename)
-
-
-def list_monthly_folders(root_folder):
-    folders = [os.path.join(root_folder, d) for d in os.listdir(root_folder)
-               if os.path.isdir(os.path.join(root_folder, d)) and d.isdigit() and len(d) == 6]
-    return sorted(folders)
-
-
-def list_files_in_folder(folder):
-    files = []
-    for root, _, filenames in os.walk(folder):
-        for filename in filenames:
-            files.append(os.path.join(root, filename))
-    return files
-
-
-def read_prefix_sheet(file_path):
-    df = pd.read_excel(file_path)
-    if 'prefix' not in df.columns:
-        raise ValueError("Prefix sheet must contain a 'prefix' column.")
-    return df['prefix'].astype(str).tolist()
-
-
-
-def read_csv_file(file_path):
-    try:
-        encoding = 'utf-8'
-        try:
-            if file_path.lower().endswith('.txt'):
-                df = pd.read_csv(file_path, sep='\t', encoding=encoding, low_memory=False)
-            else:
-                df = pd.read_csv(file_path, sep='|', encoding=encoding, low_memory=False)
-        except UnicodeDecodeError:
-            # Fallback to a different encoding like cp1252
-            fallback_encoding = 'cp1252'
-            if file_path.lower().endswith('.txt'):
-                df = pd.read_csv(file_path, sep='\t', encoding=fallback_encoding, low_memory=False)
-            else:
-                df = pd.read_csv(file_path, encoding=fallback_encoding, low_memory=False)
-
-        if df.empty:
-            raise ValueError("File is empty")
-
-        return df
-    except Exception as e:
-        raise RuntimeError(f"Error reading {file_path}: {e}")
-
-
-
-def save_dataframe(df, file_path,period):
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    part = 1
-    base_filename, ext = os.path.splitext(os.path.basename(file_path)) 
-    output_file = os.path.join(local_output_dir,f"{base_filename}_part{part}{ext}")
-    mode = 'w'
-    header = True
-    current_file_size = 0
-    
-    # Capturing expected column order from full dataframe
-    col_without_period = [col for col in df.columns if col != 'period']
-    expected_cols = col_without_period + ['period'] 
-    
-    
-    for chunk_start in range(0, len(df),10000):
-        chunk = df.iloc[chunk_start:chunk_start+10000]
-        
-        missing_cols = set(expected_cols) - set(chunk.columns)
-        for col in missing_cols:
-            chunk[col] = " "
-        chunk = chunk[expected_cols]
-        
-        # Writing chunk to memory to estimate its size
-        buffer = io.StringIO()
-        chunk.to_csv(buffer, mode=mode,header=header,sep='|',index=False, lineterminator='\n')
-        chunk_data = buffer.getvalue()
-        
-        chunk_size = len(chunk_data.encode('utf-8'))
-        # print(f"Total File Size :", (chunk_size+current_file_size)/(1024*1024))
-        
-        if current_file_size + chunk_size > MAX_FILE_SIZE_BYTES:
-            part +=1
-            output_file = os.path.join(local_output_dir,f"{base_filename}_part{part}{ext}")
-            mode = 'w'
-            header = True
-            current_file_size = 0
-            
-        with open(output_file,mode,encoding='utf-8',newline='') as f:
-            f.write(chunk_data)
-            
-        current_file_size += chunk_size    
-        mode = 'a'
-        header = False
-        
-            
-            
-def consolidate_files():
-    start = datetime.now()
-    prefixes = read_prefix_sheet(local_prefix_file)
-    monthly_folders = list_monthly_folders(local_source_prefix)
-    metadata_log = []
-    master_metadata_log = []
-    
-    
-    for prefix in prefixes:
-        logging.info(f"\n--- Consolidating files for prefix: {prefix} ---")
-        consolidated_df = pd.DataFrame()
-        prefix_matched_files = []
-        all_columns = set()
-        col_mismatch_flag = False
-
-        for folder in monthly_folders:
-            period = os.path.basename(folder)
-            files = list_files_in_folder(folder)
-
-            matched_files = [f for f in files if os.path.basename(f).lower().startswith(prefix.lower())]
-            
-            if not matched_files:
-                logging.info(f"No files for prefix '{prefix}' in folder '{period}'")
-                continue
-
-            for file_path in matched_files:
-                try:
-                    df = read_csv_file(file_path)
-                    file_stats = os.stat(file_path)
-                    file_size = round(file_stats.st_size/1024,2) # in KB
-                    row_count, col_count = df.shape
-                    timestamp = datetime.now()
-                    
-                    all_columns.add(tuple(df.columns))  #track column structure
-                    if len(all_columns) > 1:
-                        col_mismatch_flag = True
-                        
-                    metadata_log.append({
-                        'file_name':os.path.basename(file_path),
-                        'file_location':file_path,
-                        'month':period,
-                        'row_count':row_count,
-                        'col_count':col_count,
-                        'file_size_KB':file_size,
-                        'timestamp':timestamp
-                    })
-                    df['period'] = period
-                    consolidated_df = pd.concat([consolidated_df, df], ignore_index=True, sort=False)
-                    prefix_matched_files.append(file_path)
-                    logging.info(f"Appended: {file_path}")
-                except Exception as e:
-                    logging.error(f"Error reading {file_path}: {e}")
-
-        if consolidated_df.empty:
-            logging.warning(f"No data found for prefix: {prefix}")
-        elif dry_run:
-            logging.info(f"Dry run: Skipped saving for prefix {prefix}")
-        else:
-            output_file = get_output_filename(prefix)
-            save_dataframe(consolidated_df, output_file,period)
-        
-        consolidated_df['period'] = consolidated_df['period'].astype(str)
-        periods = ','.join(sorted(set(consolidated_df['period'].unique())))
-        
-        if not consolidated_df.empty:
-            total_rows, total_cols = consolidated_df.shape
-            
-            master_metadata_log.append({
-                    'prefix':prefix,
-                    'total_files': len(prefix_matched_files),
-                    'total_rows':total_rows,
-                    'total_cols':total_cols,
-                    'column_mismatch_flag':col_mismatch_flag,
-                    'start_time': process_start.strftime('%Y-%m-%d %H:%M:%S'),
-                    'end_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'periods': periods
-        })
-    if metadata_log:
-        master_df = pd.DataFrame(metadata_log)
-        master_file_path = os.path.join(local_output_dir,f"master_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-        master_df.to_csv(master_file_path, sep ='|', index=False)
-        logging.info(f"Master log saved to: {master_file_path}")
-    else:
-        logging.warning("No file information to save in master log")
-        
-    if master_metadata_log:
-        summary_df = pd.DataFrame(master_metadata_log)
-        summary_file_path = os.path.join(local_output_dir,f"summary_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
-        summary_df.to_csv(summary_file_path,sep='|',index=False)
-        logging.info(f"Summary log saved to : {summary_file_path}")
-    else:
-        logging.warning("No summary information to save")
-        
-
-           
-# ---------- Run ----------
-if __name__ == '__main__':
-    start = datetime.now() 
-    consolidate_files()
-    end = datetime.now()
-    logging.info(f"Total execution time: {end - start}")   
-    logging.info("-------------Program Completed-----------------")
+
+import pandas as pd
+import numpy as np
+import os
+import sys
+import logging
+from datetime import datetime
+import time
+import io
+import codecs
+import json
+import bisect
+import csv
+import gzip
+import hashlib
+import zlib
+import sqlite3
+import queue
+import socket
+import threading
+import argparse
+import cProfile
+import pstats
+import multiprocessing
+import logging.handlers
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from s3_storage import (is_s3_path, join_path, get_s3_client, list_s3_folders, list_s3_files, get_s3_size,
+                        has_multipart_upload, S3ObjectReader, S3MultipartWriter)
+
+try:
+    import zstandard
+except ImportError:  # only needed for output_compression = 'zstd'
+    zstandard = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for output_format = 'parquet' and parser_engine = 'pyarrow'
+    pa = None
+    pa_csv = None
+    pq = None
+
+try:
+    import xxhash
+except ImportError:  # optional: the fast part checksum falls back to zlib's CRC-32
+    xxhash = None
+
+try:
+    import psutil
+except ImportError:  # optional: RSS is read from /proc without it, and not reported where neither works
+    psutil = None
+
+try:
+    import pyinstrument
+except ImportError:  # only needed for profiler = 'pyinstrument'
+    pyinstrument = None
+
+# ---------- Configuration ----------
+MAX_FILE_SIZE_BYTES = 20*1024*1024*1024                                 #20GB Hard Limit
+local_source_prefix = r'C:\Users\AD46100\Downloads\2024'                # Root folder containing monthly folders
+local_prefix_file = r'C:\Users\AD46100\Desktop\prefix_file.xlsx'
+local_output_dir = r'C:\Users\AD46100\Desktop\output'
+dry_run = False                                                         # Set True to skip actual saving
+streaming_chunk_rows = 100000                                           # Rows read per chunk; None reads each file whole
+save_source_index = True                                                # Keep the source listing in the output folder so later runs only rescan changed folders
+workers = 1                                                             # Prefixes consolidated in parallel (separate processes)
+read_workers = 1                                                        # Files of one prefix read in parallel (threads)
+read_queue_chunks = 2                                                   # Chunks each reading thread may hold before waiting for the writer
+output_format = 'csv'                                                   # 'csv' (pipe delimited) or 'parquet' (needs pyarrow)
+output_layout = 'flat'                                                  # 'flat' (one part series per prefix) or 'hive' (prefix=X/period=YYYYMM/ folders)
+part_stats_columns = {}                                                 # Hive layout: per prefix columns whose min/max go into the part manifest, e.g. {'INP_Allowance': ['WWID']}
+part_checksums = True                                                   # sha256 and a fast checksum (xxh64, or CRC-32 without xxhash) per part, taken while writing, plus a .sha256 file per part
+verify_only = False                                                     # Only check the parts in the output dir against their .sha256 files
+index_columns = {}                                                      # Per prefix key columns indexed while writing, e.g. {'INP_Allowance': ['WWID', 'Geo_ID']}; uncompressed CSV or Parquet parts
+index_memory_rows = 20_000_000                                          # Index entries (24 bytes each) held before a sorted run is written next to the parts
+parquet_compression = 'zstd'                                            # 'zstd', 'snappy', 'gzip' or 'none'
+parquet_row_group_rows = 1000000                                        # Rows per Parquet row group
+output_compression = 'none'                                             # CSV parts: 'none', 'gzip' or 'zstd' (needs zstandard)
+compression_level = None                                                # None uses the codec default (gzip 6, zstd 3)
+zstd_threads = 0                                                        # Extra zstd compression threads, 0 compresses on the writing thread
+parser_engine = 'pandas'                                                # 'pandas' (C parser) or 'pyarrow' (multithreaded Arrow CSV reader)
+pyarrow_block_size = 16*1024*1024                                       # Bytes parsed per Arrow block (rows per chunk follow from this)
+prefix_dtypes = {}                                                      # Per prefix column types, e.g. {'INP_Allowance': {'WWID': 'int64', 'Reporting_Flag': 'category'}}
+compact_dtypes = False                                                  # Downcast integer columns and hold repetitive text columns as categoricals as chunks are read; saves memory where chunks wait (read_workers > 1, whole file reads), costs CPU
+category_max_ratio = 0.5                                                # A text column becomes categorical when its distinct values are at most this share of a chunk's rows
+category_max_values = 100_000                                           # Categories per column and prefix before the column is left as text
+prefix_jobs = {}                                                        # Per prefix columns kept and row filters, e.g. {'INP_Allowance': {'columns': ['WWID', 'Allowance_Value'], 'filters': [['Reporting_Flag', '==', 'Y']]}}
+job_spec_file = None                                                    # JSON file holding prefix_jobs, used instead of the dict above
+dialect_sample_bytes = 64*1024                                          # Bytes sampled per prefix to detect delimiter and encoding
+schema_report_only = False                                              # Only write the column mismatch report from the file headers
+split_file_bytes = 2*1024*1024*1024                                     # Files above this size are parsed in parallel byte ranges, None never splits
+split_workers = 4                                                       # Processes parsing the byte ranges of one large file
+split_range_bytes = 64*1024*1024                                        # Bytes per range handed to a split worker
+dedup_files = False                                                     # Skip files byte-identical to an earlier file of the same prefix
+dedup_keys = {}                                                         # Per prefix row key columns, e.g. {'INP_Allowance': ['WWID', 'Period']}; the first row per key is kept
+dedup_memory_keys = 100_000_000                                         # Row keys held in memory (8 bytes each) before the key set moves to SQLite on disk
+audit_only = False                                                      # Only inventory the files: line counts and headers, nothing is parsed
+audit_workers = 8                                                       # Files counted in parallel in audit mode (threads)
+incremental_runs = False                                                # Skip unchanged prefixes and resume from the manifest of earlier runs
+watch_mode = False                                                      # Keep running: poll the source root and consolidate files as they arrive
+watch_interval = 30                                                     # Seconds between polls in watch mode
+watch_settle_seconds = 10                                               # A file is picked up once unchanged for this long, so copies in progress are left alone
+watch_polls = None                                                      # Stop watch mode after this many polls, None runs until interrupted
+queue_mode = False                                                      # Claim prefixes from a work queue shared by worker processes on one or more hosts
+queue_dir = None                                                        # Shared folder for the lease files, None uses queue/ in the state dir (which must then be shared)
+queue_run = None                                                        # Name of the run the workers share, None uses today's date
+lease_seconds = 300                                                     # A lease without a heartbeat for this long is taken over by another worker
+queue_max_attempts = 3                                                  # Claims of one prefix before it is marked failed
+s3_endpoint_url = None                                                  # Only for S3 compatible stores (MinIO, moto), None uses AWS
+s3_max_connections = 16                                                 # HTTP connections per process shared by reads and uploads
+s3_upload_concurrency = 4                                               # Multipart parts uploaded at once per output part
+s3_multipart_part_bytes = 16*1024*1024                                  # Bytes per multipart upload part (S3 minimum is 5MB)
+local_state_dir = 'archival_state'                                      # Run log, manifest and source index when the output dir is on S3
+metrics_format = None                                                   # Also export run metrics: 'prometheus' (textfile collector) or 'jsonl'
+profile_prefix = None                                                   # Prefix to run under the profiler, stats are saved next to the run log
+profiler = 'cprofile'                                                   # 'cprofile' or 'pyinstrument' (sampling, needs pyinstrument)
+lookup_prefix = None                                                    # Look rows up in the key index of this prefix instead of consolidating
+lookup_keys = None                                                      # Rows to look up, 'COLUMN=VALUE,VALUE', e.g. 'WWID=1234567,7654321'
+
+process_start = datetime.now()
+
+
+# ---------- Logging ----------
+# Called from the run block only, so worker processes re-importing this file do not clear the terminal or open their own run log
+def setup_logging():
+    os.makedirs(get_state_dir(),exist_ok=True)
+    worker_suffix = f"_{get_worker_id()}" if queue_mode else ''  # queue workers may start in the same second
+    log_file_path = os.path.join(get_state_dir(),f"run_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}{worker_suffix}.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler(log_file_path),
+            logging.StreamHandler()
+        ]
+    )
+
+    # logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    logging.info("-------------Program Started-----------------")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Consolidate monthly extract files per prefix.")
+    parser.add_argument('--source', dest='local_source_prefix', help="Root folder containing monthly folders")
+    parser.add_argument('--prefix-file', dest='local_prefix_file', help="Excel sheet with a 'prefix' column")
+    parser.add_argument('--output-dir', dest='local_output_dir', help="Folder for consolidated files and logs")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=None, help="Read and log without saving")
+    parser.add_argument('--workers', dest='workers', type=int, help="Number of prefixes consolidated in parallel")
+    parser.add_argument('--output-format', dest='output_format', choices=['csv', 'parquet'], help="Format of the consolidated parts")
+    parser.add_argument('--output-layout', dest='output_layout', choices=['flat', 'hive'], help="Part series per prefix, or prefix=/period= folders")
+    parser.add_argument('--no-checksums', dest='part_checksums', action='store_false', default=None, help="Do not checksum the parts while writing")
+    parser.add_argument('--verify', dest='verify_only', action='store_true', default=None, help="Only check the parts against their .sha256 files")
+    parser.add_argument('--parquet-compression', dest='parquet_compression', choices=['zstd', 'snappy', 'gzip', 'none'], help="Parquet compression codec")
+    parser.add_argument('--compression', dest='output_compression', choices=['none', 'gzip', 'zstd'], help="Compression of CSV parts")
+    parser.add_argument('--compression-level', dest='compression_level', type=int, help="gzip or zstd compression level")
+    parser.add_argument('--zstd-threads', dest='zstd_threads', type=int, help="Extra zstd compression threads")
+    parser.add_argument('--parser-engine', dest='parser_engine', choices=['pandas', 'pyarrow'], help="CSV parser used to read the source files")
+    parser.add_argument('--schema-report', dest='schema_report_only', action='store_true', default=None, help="Only report column differences between files, from their headers")
+    parser.add_argument('--split-file-bytes', dest='split_file_bytes', type=int, help="Parse files above this size in parallel byte ranges")
+    parser.add_argument('--split-workers', dest='split_workers', type=int, help="Processes parsing the byte ranges of one large file")
+    parser.add_argument('--split-range-bytes', dest='split_range_bytes', type=int, help="Bytes per range handed to a split worker")
+    parser.add_argument('--compact-dtypes', dest='compact_dtypes', action='store_true', default=None, help="Downcast integers and hold repetitive text as categoricals as chunks are read")
+    parser.add_argument('--job-spec', dest='job_spec_file', help="JSON file with the columns kept and row filters per prefix")
+    parser.add_argument('--dedup-files', dest='dedup_files', action='store_true', default=None, help="Skip files identical to an earlier file of the same prefix")
+    parser.add_argument('--audit', dest='audit_only', action='store_true', default=None, help="Only write a master log from line counts and headers, without parsing")
+    parser.add_argument('--audit-workers', dest='audit_workers', type=int, help="Number of files counted in parallel in audit mode")
+    parser.add_argument('--incremental', dest='incremental_runs', action='store_true', default=None, help="Only consolidate files not in the manifest of earlier runs")
+    parser.add_argument('--watch', dest='watch_mode', action='store_true', default=None, help="Keep polling the source root and consolidate new files")
+    parser.add_argument('--watch-interval', dest='watch_interval', type=float, help="Seconds between polls in watch mode")
+    parser.add_argument('--watch-settle', dest='watch_settle_seconds', type=float, help="Seconds a file must be unchanged before it is picked up")
+    parser.add_argument('--watch-polls', dest='watch_polls', type=int, help="Stop watch mode after this many polls")
+    parser.add_argument('--queue', dest='queue_mode', action='store_true', default=None, help="Claim prefixes from a work queue shared with other workers")
+    parser.add_argument('--queue-dir', dest='queue_dir', help="Shared folder for the work queue's lease files")
+    parser.add_argument('--queue-run', dest='queue_run', help="Name of the run the queue workers share (default: today's date)")
+    parser.add_argument('--lease-seconds', dest='lease_seconds', type=float, help="Seconds without a heartbeat before a lease is taken over")
+    parser.add_argument('--read-workers', dest='read_workers', type=int, help="Number of files of a prefix read in parallel")
+    parser.add_argument('--s3-endpoint-url', dest='s3_endpoint_url', help="Endpoint of an S3 compatible store for s3:// paths")
+    parser.add_argument('--metrics', dest='metrics_format', choices=['prometheus', 'jsonl'], help="Export run metrics for graphing")
+    parser.add_argument('--profile-prefix', dest='profile_prefix', help="Run this prefix under the profiler")
+    parser.add_argument('--profiler', dest='profiler', choices=['cprofile', 'pyinstrument'], help="Profiler used for --profile-prefix")
+    parser.add_argument('--lookup-prefix', dest='lookup_prefix', help="Look rows up in the key index of this prefix")
+    parser.add_argument('--lookup', dest='lookup_keys', help="Rows to look up, as COLUMN=VALUE,VALUE")
+    parser.add_argument('--state-dir', dest='local_state_dir', help="Local folder for the run log and manifest when the output is on S3")
+    return parser.parse_args()
+
+
+applied_options = {}  # handed on to worker processes, which re-import this file with the defaults above
+
+
+def apply_options(options):
+    # Command line values override the configuration above; unset options keep their defaults
+    for name, value in options.items():
+        if value is not None:
+            globals()[name] = value
+            applied_options[name] = value
+
+
+def get_rss_bytes():
+    # Resident memory of this process, None where it cannot be read (Windows without psutil)
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def to_mb(num_bytes):
+    return round(num_bytes / (1024*1024), 1) if num_bytes is not None else None
+
+
+def init_worker(options, log_queue, run_start):
+    global process_start
+    apply_options(options)
+    process_start = run_start
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+
+
+# ---------- Storage ----------
+# Source and output folders may be local paths or s3://bucket/prefix URLs
+def get_s3():
+    return get_s3_client(s3_endpoint_url, s3_max_connections)
+
+
+def get_state_dir():
+    # The manifest and source index are appended to and renamed in place, which S3 objects cannot do
+    return local_state_dir if is_s3_path(local_output_dir) else local_output_dir
+
+
+def join_output_path(parent, *names):
+    if is_s3_path(parent):
+        return join_path(parent, *names)
+    return os.path.join(parent, *names)
+
+
+def get_parent_path(file_path):
+    if is_s3_path(file_path):
+        return file_path.rsplit('/', 1)[0]
+    return os.path.dirname(file_path)
+
+
+def get_output_path(*names):
+    return join_output_path(local_output_dir, *names)
+
+
+def open_source(file_path, length=None, start=0):
+    # length limits an S3 read to a ranged GET of the bytes from start instead of streaming the whole object
+    if is_s3_path(file_path):
+        return io.BufferedReader(S3ObjectReader(get_s3(), file_path, length, start), buffer_size=1024*1024)
+    f = open(file_path, 'rb')
+    if start:
+        f.seek(start)
+    return f
+
+
+def open_output(file_path):
+    # S3 parts stream into a multipart upload and only appear once closed
+    if is_s3_path(file_path):
+        return S3MultipartWriter(get_s3(), file_path, s3_multipart_part_bytes, s3_upload_concurrency)
+    return open(file_path, 'wb', buffering=1024*1024)
+
+
+def abort_output(handle):
+    # Closes an output handle without publishing it: an S3 upload is aborted, a local file is closed as it is
+    if hasattr(handle, 'abort'):
+        handle.abort()
+    else:
+        handle.close()
+
+
+def get_path_size(file_path):
+    # None when the file does not exist
+    if is_s3_path(file_path):
+        return get_s3_size(get_s3(), file_path)
+    return os.path.getsize(file_path) if os.path.exists(file_path) else None
+
+
+def is_part_started(part_path):
+    # True once anything of the part was written: the part itself, a compressed part still under its .partial
+    # name, or an S3 multipart upload that a crashed process never completed
+    if get_path_size(part_path) is not None:
+        return True
+    if is_s3_path(part_path):
+        return has_multipart_upload(get_s3(), part_path)
+    return os.path.exists(part_path + '.partial')
+
+
+def get_output_extension():
+    if output_format == 'parquet':
+        return '.parquet'
+    if output_compression != 'none':
+        return '.csv' + COMPRESSED_EXTENSIONS[output_compression]
+    return '.csv'
+
+
+def get_output_filename(prefix):
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f"consolidated_{prefix}_{timestamp}{get_output_extension()}"
+    if output_layout == 'hive':
+        # Only a base name: the parts go into the period= folders below prefix=X
+        return get_output_path(f"prefix={prefix}", filename)
+    return get_output_path(filename)
+
+
+def list_monthly_folders(root_folder):
+    if is_s3_path(root_folder):
+        return sorted(path for name, path in list_s3_folders(get_s3(), root_folder) if name.isdigit() and len(name) == 6)
+    folders = [os.path.join(root_folder, d) for d in os.listdir(root_folder)
+               if os.path.isdir(os.path.join(root_folder, d)) and d.isdigit() and len(d) == 6]
+    return sorted(folders)
+
+
+def scan_folder_tree(folder, cached_folders, scanned_folders):
+    # Re-lists a folder only when its mtime changed; unchanged folders reuse the cached listing.
+    # Files rewritten in place do not change their folder mtime, so delete the index file to force a full rescan.
+    folder_mtime = os.stat(folder).st_mtime_ns
+    entry = cached_folders.get(folder)
+    if entry is None or entry['mtime'] != folder_mtime:
+        entry = {'mtime': folder_mtime, 'files': [], 'dirs': []}
+        with os.scandir(folder) as it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    if not dir_entry.is_symlink():  # same as os.walk, symlinked folders are not followed
+                        entry['dirs'].append(dir_entry.name)
+                else:
+                    file_stats = dir_entry.stat()
+                    entry['files'].append([dir_entry.name, file_stats.st_size, file_stats.st_mtime_ns])
+    scanned_folders[folder] = entry
+    for name in entry['dirs']:
+        scan_folder_tree(os.path.join(folder, name), cached_folders, scanned_folders)
+
+
+def list_s3_source(monthly_folders):
+    # One paginated listing per month, filtered server side by the folder prefix; not cached since
+    # the listing already is the cheap part (1000 keys per request) and objects carry no folder mtime
+    entries = []
+    for monthly_folder in monthly_folders:
+        period = os.path.basename(monthly_folder)
+        for name, path, size, mtime in list_s3_files(get_s3(), monthly_folder):
+            entries.append((name.lower(), period, path, size, mtime))
+    return entries
+
+
+def build_source_index(monthly_folders, index_file_path=None, cached_folders=None):
+    # cached_folders, when given, is the 'folders' listing of an earlier index kept in memory (watch mode)
+    if monthly_folders and is_s3_path(monthly_folders[0]):
+        entries = sorted(list_s3_source(monthly_folders))
+        logging.info(f"Indexed {len(entries)} objects in {len(monthly_folders)} monthly folders")
+        return {'keys': [entry[0] for entry in entries], 'entries': entries, 'folders': None}
+
+    if cached_folders is None:
+        cached_folders = {}
+    if index_file_path and os.path.exists(index_file_path):
+        try:
+            with open(index_file_path, 'r', encoding='utf-8') as f:
+                cached_folders = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable source index {index_file_path}: {e}")
+
+    scanned_folders = {}
+    entries = []
+    for monthly_folder in monthly_folders:
+        period = os.path.basename(monthly_folder)
+        folder_start = len(scanned_folders)
+        scan_folder_tree(monthly_folder, cached_folders, scanned_folders)
+        for folder in list(scanned_folders)[folder_start:]:
+            for name, size, mtime in scanned_folders[folder]['files']:
+                entries.append((name.lower(), period, os.path.join(folder, name), size, mtime))
+
+    if index_file_path:
+        tmp_path = index_file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(scanned_folders, f)
+        os.replace(tmp_path, index_file_path)
+
+    entries.sort()
+    logging.info(f"Indexed {len(entries)} files in {len(scanned_folders)} folders")
+    return {'keys': [entry[0] for entry in entries], 'entries': entries, 'folders': scanned_folders}
+
+
+def find_prefix_files(source_index, prefix):
+    # Filenames are sorted, so every match for a prefix sits in one contiguous run starting at the bisect point
+    prefix = prefix.lower()
+    keys = source_index['keys']
+    matches = []
+    i = bisect.bisect_left(keys, prefix)
+    while i < len(keys) and keys[i].startswith(prefix):
+        _, period, file_path, size, mtime = source_index['entries'][i]
+        matches.append({'period': period, 'file_path': file_path, 'file_size': size, 'file_mtime': mtime})
+        i += 1
+    return sorted(matches, key=lambda match: (match['period'], match['file_path']))
+
+
+def read_prefix_sheet(file_path):
+    df = pd.read_excel(file_path)
+    if 'prefix' not in df.columns:
+        raise ValueError("Prefix sheet must contain a 'prefix' column.")
+    return df['prefix'].astype(str).tolist()
+
+
+
+DELIMITER_NAMES = {'|': 'pipe', '\t': 'tab', ',': 'comma', ';': 'semicolon'}
+decode_state = threading.local()
+
+
+def decode_cp1252_fallback(error):
+    # Bytes that are not valid utf-8 are decoded as cp1252 in the same pass, so a file is never parsed twice.
+    # cp1252 text is almost never valid utf-8, which lets one read handle utf-8, cp1252 and mixed files.
+    decode_state.fallbacks = getattr(decode_state, 'fallbacks', 0) + 1
+    return error.object[error.start:error.end].decode('cp1252', errors='replace'), error.end
+
+
+codecs.register_error('cp1252_fallback', decode_cp1252_fallback)
+
+
+
+def detect_dialect(file_path):
+    # Decides delimiter and encoding from the first dialect_sample_bytes of the file
+    with open_source(file_path, dialect_sample_bytes) as f:
+        sample = f.read(dialect_sample_bytes)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample)  # not final: the sample may end mid character
+        encoding = 'utf-8'
+    except UnicodeDecodeError:
+        encoding = 'cp1252'
+    lines = sample.decode('utf-8', errors='cp1252_fallback').splitlines()
+    if len(sample) == dialect_sample_bytes:
+        lines = lines[:-1]  # last line may be cut off
+    lines = lines[:20]
+
+    sep = '\t' if file_path.lower().endswith('.txt') else '|'
+    best_score = (0, 0)
+    for candidate in DELIMITER_NAMES:
+        header_count = lines[0].count(candidate) if lines else 0
+        if header_count == 0:
+            continue
+        consistent_lines = sum(1 for line in lines if line.count(candidate) == header_count)
+        if (consistent_lines, header_count) > best_score:
+            best_score = (consistent_lines, header_count)
+            sep = candidate
+    return {'sep': sep, 'encoding': encoding}
+
+
+def get_read_options(dialect):
+    # Always utf-8 with the cp1252 fallback, whatever the sample showed, so a late cp1252 byte cannot fail the read
+    return {'sep': dialect['sep'], 'encoding': 'utf-8', 'encoding_errors': 'cp1252_fallback', 'low_memory': False}
+
+
+def dedupe_columns(names):
+    # Same naming pandas uses for blank and repeated header names
+    columns = []
+    for i, name in enumerate(names):
+        name = name or f"Unnamed: {i}"
+        if name in columns:
+            count = 1
+            while f"{name}.{count}" in columns or f"{name}.{count}" in names:
+                count += 1
+            name = f"{name}.{count}"
+        columns.append(name)
+    return columns
+
+
+def read_csv_header(file_path, dialect):
+    # Only the first line is read; the parsers are then given these names so planning and parsing agree
+    with open_source(file_path) as f:
+        line = f.readline()
+    text = line.decode('utf-8', errors='cp1252_fallback').lstrip('\ufeff').rstrip('\r\n')
+    if not text:
+        raise ValueError("File is empty")
+    return dedupe_columns(next(csv.reader([text], delimiter=dialect['sep'])))
+
+
+class HashingReader(io.RawIOBase):
+    # Hashes the bytes as the parser pulls them, so the content hash costs no extra pass over the file
+    def __init__(self, file_path):
+        if is_s3_path(file_path):
+            self.raw = S3ObjectReader(get_s3(), file_path)
+        else:
+            self.raw = open(file_path, 'rb', buffering=0)
+        self.hasher = hashlib.blake2b(digest_size=16)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        if size:
+            self.hasher.update(memoryview(buffer)[:size])
+        return size
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+FAST_CHECKSUM = 'xxh64' if xxhash is not None else 'crc32'
+
+
+class HashingWriter(io.RawIOBase):
+    # Hashes the bytes on their way into a part, so the part checksums cost no read back.
+    # sha256 is the one to trust; the fast checksum lets a quick check skip the cost of sha256.
+    def __init__(self, raw, state=None):
+        # state, from state(), continues the checksums of a part that is appended to
+        self.raw = raw
+        if state is not None:
+            hasher, fast_hasher, self.crc = state
+            self.hasher = hasher.copy()
+            self.fast_hasher = fast_hasher.copy() if fast_hasher is not None else None
+        else:
+            self.hasher = hashlib.sha256()
+            self.fast_hasher = xxhash.xxh64() if xxhash is not None else None
+            self.crc = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.hasher.update(data)
+        if self.fast_hasher is not None:
+            self.fast_hasher.update(data)
+        else:
+            self.crc = zlib.crc32(data, self.crc)
+        return self.raw.write(data)
+
+    def checksums(self):
+        fast = self.fast_hasher.hexdigest() if self.fast_hasher is not None else f"{self.crc:08x}"
+        return {'sha256': self.hasher.hexdigest(), FAST_CHECKSUM: fast}
+
+    def state(self):
+        return self.hasher, self.fast_hasher, self.crc
+
+    def tell(self):
+        return self.raw.tell()
+
+    def flush(self):
+        if not self.raw.closed:
+            self.raw.flush()
+
+    def abort(self):
+        abort_output(self.raw)
+        super().close()
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()  # flushes through to raw before it is closed
+        self.raw.close()
+
+
+def get_prefix_setting(settings, prefix, default):
+    for setting_prefix, value in settings.items():
+        if setting_prefix.lower() == prefix.lower():
+            return value
+    return default
+
+
+def get_prefix_dtypes(prefix):
+    return get_prefix_setting(prefix_dtypes, prefix, {})
+
+
+FILTER_OPERATORS = {
+    '==': lambda column, value: column == value,
+    '!=': lambda column, value: column != value,
+    '<': lambda column, value: column < value,
+    '<=': lambda column, value: column <= value,
+    '>': lambda column, value: column > value,
+    '>=': lambda column, value: column >= value,
+    'in': lambda column, value: column.isin(value),
+    'not in': lambda column, value: ~column.isin(value),
+}
+
+
+def get_prefix_job(prefix):
+    # Returns the columns to keep (None keeps all) and the row filters of the prefix
+    jobs = prefix_jobs
+    if job_spec_file:
+        with open_source(job_spec_file) as f:
+            jobs = json.load(f)
+    job = get_prefix_setting(jobs, prefix, {})
+    for col, operator, value in job.get('filters', []):
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unknown filter operator {operator!r} for prefix {prefix}, use one of {', '.join(FILTER_OPERATORS)}")
+    return job.get('columns'), [list(row_filter) for row_filter in job.get('filters', [])]
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def apply_row_filters(chunk, row_filters):
+    # Keeps the rows matching every filter, one vectorized comparison per filter.
+    # Numeric values compare the column as numbers and text values as text, whatever the column parsed as;
+    # a blank or missing value matches no filter.
+    keep = np.ones(len(chunk), dtype=bool)
+    for col, operator, value in row_filters:
+        if col not in chunk:
+            return chunk.iloc[:0]
+        values = value if operator in ('in', 'not in') else [value]
+        if all(is_number(item) for item in values):
+            column = pd.to_numeric(chunk[col], errors='coerce').astype('Float64')
+        else:
+            column = chunk[col].astype('string')
+            value = [str(item) for item in value] if operator in ('in', 'not in') else str(value)
+        matches = FILTER_OPERATORS[operator](column, value)
+        keep &= matches.fillna(False).to_numpy(dtype=bool) & column.notna().to_numpy()
+    return chunk if keep.all() else chunk[keep]
+
+
+def get_arrow_type(dtype):
+    dtype = str(dtype).lower()
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.from_numpy_dtype(np.dtype(dtype))
+
+
+def arrow_batch_to_pandas(batch):
+    # Arrow backed strings instead of one Python object per value.
+    # Text is read without the utf-8 check, so a column holding invalid utf-8 is viewed as binary here and decoded below.
+    for i, field in enumerate(batch.schema):
+        if pa.types.is_string(field.type):
+            try:
+                batch.column(i).validate(full=True)
+            except pa.ArrowInvalid:
+                batch = batch.set_column(i, field.name, batch.column(i).view(pa.binary()))
+    df = batch.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}.get)
+    # Only the columns holding invalid utf-8 are decoded with the cp1252 fallback
+    for field in batch.schema:
+        if pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+            df[field.name] = df[field.name].map(lambda value: value if value is None else value.decode('utf-8', 'cp1252_fallback'))
+    return df
+
+
+def read_arrow_chunks(f, dialect, chunksize, dtypes, columns, usecols=None):
+    # Header names come from the pandas header read so both engines produce the same (de-duplicated) columns.
+    # Columns without a prefix dtype are read as text: the streaming reader fixes the types from its first block, so an
+    # inferred column empty there would be typed null and fail on its first value, and a cp1252 byte in a later block
+    # would fail the utf-8 check.
+    if pa_csv is None:
+        raise RuntimeError("parser_engine 'pyarrow' needs pyarrow installed")
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=pyarrow_block_size, column_names=columns, skip_rows=1)
+    parse_options = pa_csv.ParseOptions(delimiter=dialect['sep'])
+    column_types = {col: pa.string() for col in columns or []}
+    column_types.update({col: get_arrow_type(dtype) for col, dtype in dtypes.items()
+                         if str(dtype).lower() not in ('str', 'string', 'object')})
+    convert_options = pa_csv.ConvertOptions(column_types=column_types, include_columns=usecols, check_utf8=False)
+    if chunksize is None:
+        # Whole file reads use Arrow's multithreaded reader
+        table = pa_csv.read_csv(f, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+        for batch in table.to_batches():
+            yield arrow_batch_to_pandas(batch)
+        return
+    # The streaming reader parses one block at a time, keeping memory bounded by pyarrow_block_size
+    reader = pa_csv.open_csv(f, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+    for batch in reader:
+        yield arrow_batch_to_pandas(batch)
+
+
+def read_csv_chunks(file_path, dialect, chunksize=None, file_info=None, dtypes=None, columns=None, usecols=None):
+    # file_info, when given, receives the content hash and the encoding actually met once the whole file has been read.
+    # usecols limits parsing to those columns; the others are only scanned past.
+    read_options = get_read_options(dialect)
+    if columns is not None:
+        read_options.update(header=0, names=columns)
+    if usecols is not None:
+        read_options['usecols'] = usecols
+    if dtypes:
+        read_options['dtype'] = dtypes
+    hashing_reader = HashingReader(file_path)
+    decode_state.fallbacks = 0
+    with io.BufferedReader(hashing_reader, buffer_size=1024*1024) as f:
+        if parser_engine == 'pyarrow':
+            yield from read_arrow_chunks(f, dialect, chunksize, dtypes or {}, columns, usecols)
+        elif chunksize is None:
+            yield pd.read_csv(f, **read_options)
+        else:
+            with pd.read_csv(f, chunksize=chunksize, **read_options) as reader:
+                for chunk in reader:
+                    yield chunk
+        if file_info is not None:
+            file_info['content_hash'] = hashing_reader.hasher.hexdigest()
+            file_info['encoding'] = 'cp1252' if decode_state.fallbacks else 'utf-8'
+
+
+def get_row_keys(chunk, key_columns):
+    # 64-bit hash per row over the text of the key columns. A column parsed as int in one chunk and as float
+    # (because of blanks) in another is put back to whole numbers first, so both give the same keys.
+    keys = chunk.reindex(columns=key_columns)
+    for col in key_columns:
+        column = keys[col]
+        if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+            column = column.astype('Int64')
+        keys[col] = column.astype('string')
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+class ChunkCompactor:
+    # Shrinks the chunks of one prefix as they are read, before they wait in a read queue: integer columns are downcast
+    # to the smallest type that holds them and text columns with few distinct values (period among them) become
+    # categoricals. The categories of a column are shared by all chunks of the prefix, new values appended as they show
+    # up, so the codes of every chunk index the same list. Floats are left alone as float32 would print other digits.
+    # Reading threads share one compactor, so compact() holds a lock. Memory is measured before and after each chunk.
+    def __init__(self):
+        self.dtypes = {}  # column: CategoricalDtype shared by the chunks of the prefix
+        self.text_columns = set()  # columns past category_max_values, kept as text
+        self.memory_before = 0
+        self.memory_after = 0
+        self.lock = threading.Lock()
+
+    def to_category(self, col, column):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+        else:
+            codes, uniques = pd.factorize(column)
+            if col not in self.dtypes and len(uniques) > category_max_ratio * len(column):
+                return None
+        if len(uniques) == 0:
+            return None
+        uniques = pd.Index(np.asarray(uniques, dtype=object), dtype=object)
+        dtype = self.dtypes.get(col)
+        known = dtype.categories if dtype is not None else pd.Index([], dtype=object)
+        positions = known.get_indexer(uniques)
+        if (positions < 0).any():
+            known = known.append(uniques[positions < 0])
+            if len(known) > category_max_values:
+                logging.info(f"Column {col} passed {category_max_values} distinct values, keeping it as text")
+                self.text_columns.add(col)
+                self.dtypes.pop(col, None)
+                return None
+            dtype = self.dtypes[col] = pd.CategoricalDtype(known)
+            positions = known.get_indexer(uniques)
+        codes = np.where(codes >= 0, positions[codes], -1)
+        return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=column.index, name=col)
+
+    def compact(self, chunk):
+        with self.lock:
+            columns = {}
+            for col in chunk.columns:
+                column = chunk[col]
+                compacted = None
+                if pd.api.types.is_integer_dtype(column.dtype):
+                    unsigned = pd.api.types.is_unsigned_integer_dtype(column.dtype)
+                    compacted = pd.to_numeric(column, downcast='unsigned' if unsigned else 'integer')
+                elif col not in self.text_columns and (isinstance(column.dtype, pd.CategoricalDtype) or
+                                                       pd.api.types.is_string_dtype(column.dtype)):
+                    compacted = self.to_category(col, column)
+                columns[col] = column if compacted is None else compacted
+            compacted = pd.DataFrame(columns, index=chunk.index)
+            self.memory_before += int(chunk.memory_usage(index=False, deep=True).sum())
+            self.memory_after += int(compacted.memory_usage(index=False, deep=True).sum())
+            return compacted
+
+
+class RowKeySet:
+    # Row keys seen so far for one prefix. In memory the keys are sorted uint64 runs, merged whenever a run
+    # grows to the size of the one before it, so lookups stay a few binary searches at 8 bytes per key.
+    # Past dedup_memory_keys the keys move to an SQLite table on disk.
+    # With 64-bit keys the chance of any two distinct keys colliding stays below 0.1% up to 190 million keys.
+    def __init__(self, key_columns, spill_path):
+        self.key_columns = key_columns
+        self.spill_path = spill_path
+        self.runs = []
+        self.count = 0
+        self.db = None
+
+    def contains(self, keys):
+        if self.db is not None:
+            self.db.execute("DELETE FROM batch")
+            self.db.executemany("INSERT INTO batch VALUES (?)", ((key,) for key in keys.view(np.int64).tolist()))
+            found = [row[0] for row in self.db.execute("SELECT key FROM batch WHERE key IN (SELECT key FROM seen)")]
+            return np.isin(keys.view(np.int64), np.array(found, dtype=np.int64))
+        found = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[positions] == keys
+        return found
+
+    def add(self, keys):
+        # keys are unique and not in the set yet
+        if len(keys) == 0:
+            return  # an empty run would break the binary search in contains
+        self.count += len(keys)
+        if self.db is None and self.count > dedup_memory_keys:
+            self.spill()
+        if self.db is not None:
+            self.db.executemany("INSERT INTO seen VALUES (?)", ((key,) for key in keys.view(np.int64).tolist()))
+            return
+        self.runs.append(np.sort(keys))
+        while len(self.runs) > 1 and len(self.runs[-1]) * 2 >= len(self.runs[-2]):
+            last = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], last]))
+
+    def spill(self):
+        logging.info(f"Row key set passed {dedup_memory_keys} keys, moving it to {self.spill_path}")
+        os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+        self.db = sqlite3.connect(self.spill_path)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE seen (key INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TEMP TABLE batch (key INTEGER)")
+        for run in self.runs:
+            self.db.executemany("INSERT INTO seen VALUES (?)", ((key,) for key in run.view(np.int64).tolist()))
+        self.runs = []
+
+    def drop_seen(self, chunk):
+        # Keeps the first row per key, within the chunk and against all earlier chunks
+        keys = get_row_keys(chunk, self.key_columns)
+        first = ~pd.Series(keys).duplicated().to_numpy()
+        first_positions = np.flatnonzero(first)
+        new = ~self.contains(keys[first_positions])
+        self.add(keys[first_positions[new]])
+        if len(first_positions) == len(keys) and new.all():
+            return chunk
+        keep = np.zeros(len(chunk), dtype=bool)
+        keep[first_positions[new]] = True
+        return chunk[keep]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            os.remove(self.spill_path)
+
+
+def find_duplicate_files(prefix_files, completed_files):
+    # Files can only be identical when their sizes are, so only files sharing a size with another one are hashed.
+    # Returns the files to read and the duplicates, each marked with the earlier file it repeats.
+    completed = [record for record in completed_files.values() if not record.get('duplicate_of')]
+    sizes = Counter([prefix_file['file_size'] for prefix_file in prefix_files] + [record['file_size_bytes'] for record in completed])
+    seen = {(record['file_size_bytes'], record['content_hash']): record['file_location'] for record in completed}
+    unique_files = []
+    duplicate_files = []
+    for prefix_file in prefix_files:
+        if sizes[prefix_file['file_size']] > 1:
+            content_hash = count_file_lines(prefix_file['file_path'])[1]
+            duplicate_of = seen.setdefault((prefix_file['file_size'], content_hash), prefix_file['file_path'])
+            if duplicate_of != prefix_file['file_path']:
+                duplicate_files.append(dict(prefix_file, content_hash=content_hash, duplicate_of=duplicate_of))
+                continue
+        unique_files.append(prefix_file)
+    return unique_files, duplicate_files
+
+
+def record_duplicate_files(duplicate_files, metadata_log, manifest_path=None):
+    for prefix_file in duplicate_files:
+        logging.info(f"Skipped: {prefix_file['file_path']} | identical to {prefix_file['duplicate_of']}")
+        metadata_log.append({
+            'file_name':os.path.basename(prefix_file['file_path']),
+            'file_location':prefix_file['file_path'],
+            'month':prefix_file['period'],
+            'row_count':0,
+            'col_count':len(prefix_file['columns']),
+            'missing_columns':','.join(prefix_file['missing_columns']),
+            'file_size_KB':round(prefix_file['file_size']/1024,2),
+            'delimiter':DELIMITER_NAMES[prefix_file['dialect']['sep']],
+            'encoding':None,
+            'content_hash':prefix_file['content_hash'],
+            'duplicate_of':prefix_file['duplicate_of'],
+            'filtered_rows':0,
+            'duplicate_rows':0,
+            'timestamp':datetime.now()
+        })
+        if manifest_path:
+            # Not a 'file' record: nothing was written, so it must not become the resume point
+            append_manifest_record(manifest_path, dict(
+                metadata_log[-1],
+                record_type='duplicate',
+                file_size_bytes=prefix_file['file_size'],
+                file_mtime=prefix_file['file_mtime'],
+                dialect=prefix_file['dialect'],
+                columns=prefix_file['columns']
+            ))
+
+
+def should_split(prefix_file):
+    # pyarrow already parses blocks of a file on several threads
+    return (split_file_bytes is not None and split_workers > 1 and parser_engine == 'pandas'
+            and prefix_file['file_size'] > split_file_bytes and not is_s3_path(prefix_file['file_path']))
+
+
+def plan_byte_ranges(file_path, file_size):
+    # Ranges of about split_range_bytes, each moved forward to just after a line break; the first starts after the header
+    boundaries = []
+    with open(file_path, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            line_end = -1
+            while line_end == -1:
+                block = f.read(64*1024)
+                if not block:
+                    break
+                line_end = block.find(b'\n')
+                if line_end == -1:
+                    offset += len(block)
+            if line_end == -1:
+                break
+            offset += line_end + 1
+            boundaries.append(offset)
+            offset += split_range_bytes
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def parse_byte_range(file_path, start, end, dialect, columns, dtypes, usecols=None):
+    # Runs in a split worker. A range holding a quote character is not parsed: a quoted field may carry a line
+    # break, so the range end may not be a row end. Returns the rows, whether quotes were seen and cp1252 fallbacks.
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if data.find(b'"') != -1:
+        return None, True, 0
+    read_options = dict(get_read_options(dialect), header=None, names=columns, usecols=usecols)
+    if dtypes:
+        read_options['dtype'] = dtypes
+    decode_state.fallbacks = 0
+    df = pd.read_csv(io.BytesIO(data), **read_options)
+    return df, False, decode_state.fallbacks
+
+
+def read_byte_ranges(prefix_file, chunksize=None):
+    # Splits a large file into line aligned byte ranges parsed by split_workers processes, yielded in file order.
+    # Ranges are only handed to the writer once known to hold no quote characters, so every range boundary met is a
+    # row boundary; from the first range with quotes the rest of the file is parsed on this thread instead.
+    # The content hash is taken on a separate thread over the whole file, so it matches the unsplit read.
+    file_path, dialect, columns, dtypes = prefix_file['file_path'], prefix_file['dialect'], prefix_file['columns'], prefix_file['dtypes']
+    usecols = prefix_file.get('usecols')
+    ranges = plan_byte_ranges(file_path, prefix_file['file_size'])
+    logging.info(f"Parsing {file_path} in {len(ranges)} byte ranges on {split_workers} processes")
+    fallbacks = 0
+    hash_executor = ThreadPoolExecutor(max_workers=1)
+    executor = ProcessPoolExecutor(max_workers=split_workers, initializer=apply_options, initargs=(applied_options,))
+    try:
+        hash_future = hash_executor.submit(count_file_lines, file_path)
+        pending = deque()
+        next_range = 0
+        while pending or next_range < len(ranges):
+            while next_range < len(ranges) and len(pending) < split_workers:  # caps memory at split_workers ranges
+                start, end = ranges[next_range]
+                pending.append((start, executor.submit(parse_byte_range, file_path, start, end, dialect, columns, dtypes,
+                                                                usecols)))
+                next_range += 1
+            start, future = pending.popleft()
+            df, quoted, range_fallbacks = future.result()
+            if quoted:
+                logging.warning(f"Quote characters in {file_path} after byte {start}, parsing the rest on one core")
+                for _, other in pending:
+                    other.cancel()
+                pending.clear()
+                fallbacks += yield from read_from_offset(file_path, start, dialect, columns, dtypes, chunksize, usecols)
+                break
+            fallbacks += range_fallbacks
+            yield df
+        prefix_file['content_hash'] = hash_future.result()[1]
+        prefix_file['encoding'] = 'cp1252' if fallbacks else 'utf-8'
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        hash_executor.shutdown(wait=True)
+
+
+def read_from_offset(file_path, start, dialect, columns, dtypes, chunksize=None, usecols=None):
+    # Parses from a row boundary to the end of the file; returns the number of cp1252 fallbacks
+    read_options = dict(get_read_options(dialect), header=None, names=columns, usecols=usecols)
+    if dtypes:
+        read_options['dtype'] = dtypes
+    decode_state.fallbacks = 0
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        if chunksize is None:
+            yield pd.read_csv(f, **read_options)
+        else:
+            with pd.read_csv(f, chunksize=chunksize, **read_options) as reader:
+                for chunk in reader:
+                    yield chunk
+    return decode_state.fallbacks
+
+
+COMPRESSED_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def get_part_filename(file_path, part):
+    # consolidated_X.csv.gz -> consolidated_X_part1.csv.gz
+    base_filename = os.path.basename(file_path)
+    compressed_ext = ''
+    for ext in COMPRESSED_EXTENSIONS.values():
+        if base_filename.endswith(ext):
+            base_filename, compressed_ext = base_filename[:-len(ext)], ext
+    base_filename, ext = os.path.splitext(base_filename)
+    return join_output_path(get_parent_path(file_path), f"{base_filename}_part{part}{ext}{compressed_ext}")
+
+
+def write_checksum_file(part_path, sha256):
+    # Same format as sha256sum, so `sha256sum -c` run in the part's folder checks it too
+    data = f"{sha256}  {os.path.basename(part_path)}\n".encode('utf-8')
+    with open_output(part_path + '.sha256') as f:
+        f.write(data)
+
+
+def get_part_label(part):
+    return f"{part['period']}/{part['part']}" if 'period' in part else str(part['part'])
+
+
+def get_partition_path(file_path, period):
+    # prefix=X/consolidated_X.csv -> prefix=X/period=202401/consolidated_X.csv
+    return join_output_path(get_parent_path(file_path), f"period={period}", os.path.basename(file_path))
+
+
+def strip_output_extension(file_path):
+    # consolidated_X.csv.gz -> consolidated_X, from the name itself so a run with other format options finds the files
+    for ext in COMPRESSED_EXTENSIONS.values():
+        if file_path.endswith(ext):
+            file_path = file_path[:-len(ext)]
+    return os.path.splitext(file_path)[0]
+
+
+def get_part_manifest_path(file_path):
+    return strip_output_extension(file_path) + '_parts.json'
+
+
+def write_part_manifest(file_path, columns, parts, stats_columns):
+    # Lets readers prune to the parts they need: period, rows, bytes, column min/max and checksum per part.
+    # Part paths are relative to the manifest's folder.
+    parent = get_parent_path(file_path)
+    manifest = {
+        'output_file': os.path.basename(file_path),
+        'columns': columns,
+        'stats_columns': stats_columns,
+        'parts': [dict(part, path=part['path'][len(parent) + 1:] if part['path'].startswith(parent) else part['path'])
+                  for part in parts]
+    }
+    manifest_path = get_part_manifest_path(file_path)
+    data = json.dumps(manifest, indent=1, default=str).encode('utf-8')
+    if is_s3_path(manifest_path):
+        with open_output(manifest_path) as f:
+            f.write(data)
+    else:
+        with open(manifest_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    logging.info(f"Part manifest saved to: {manifest_path}")
+
+
+def load_part_manifest(file_path):
+    # None when the manifest is missing, e.g. after a run that did not finish
+    manifest_path = get_part_manifest_path(file_path)
+    if get_path_size(manifest_path) is None:
+        return None
+    with open_source(manifest_path) as f:
+        return json.load(f)
+
+
+def to_json_value(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def pick_value(func, current, value):
+    # Columns can parse as numbers in one chunk and as text in another; those are compared as text
+    try:
+        return func(current, value)
+    except TypeError:
+        return func(str(current), str(value))
+
+
+def update_part_stats(part, chunk, stats_columns):
+    for col in stats_columns:
+        if col not in chunk:
+            continue
+        values = chunk[col].dropna()
+        if values.empty:
+            continue
+        try:
+            low, high = values.min(), values.max()
+        except TypeError:
+            values = values.astype(str)
+            low, high = values.min(), values.max()
+        low, high = to_json_value(low), to_json_value(high)
+        part_min = part.setdefault('min', {})
+        part_max = part.setdefault('max', {})
+        part_min[col] = pick_value(min, part_min[col], low) if col in part_min else low
+        part_max[col] = pick_value(max, part_max[col], high) if col in part_max else high
+
+
+INDEX_DTYPE = np.dtype([('key', '<u8'), ('part', '<u4'), ('length', '<u4'), ('offset', '<u8')])
+
+
+def get_key_index_path(file_path):
+    return strip_output_extension(file_path) + '_index.json'
+
+
+def get_index_columns(prefix):
+    # Compressed CSV parts cannot be read from a byte offset, so they are not indexed
+    if output_format == 'csv' and output_compression != 'none':
+        return []
+    return get_prefix_setting(index_columns, prefix, [])
+
+
+def load_key_index(file_path):
+    # None when the prefix has no index, or its last run did not finish
+    index_path = get_key_index_path(file_path)
+    if get_path_size(index_path) is None:
+        return None
+    with open_source(index_path) as f:
+        return json.load(f)
+
+
+class KeyIndexWriter:
+    # Key -> (part, byte offset, row length) index per column, built while the parts are written.
+    # Keys are the 64-bit hashes of get_row_keys. Entries are collected per chunk and every index_memory_rows
+    # entries a run sorted by key is saved as .npy next to the parts, so memory stays bounded and a lookup is
+    # a binary search per run. For Parquet parts the offset is the row number in the part.
+    def __init__(self, file_path, columns, index_state=None):
+        self.file_path = file_path
+        self.parent = get_parent_path(file_path)
+        self.columns = columns
+        self.parts = list(index_state['parts']) if index_state else []  # part paths relative to the index
+        self.part_ids = {part: i for i, part in enumerate(self.parts)}
+        self.runs = {col: list(index_state['runs'][col]) if index_state else [] for col in columns}
+        self.pending = {col: [] for col in columns}
+        self.pending_rows = 0
+
+    def add(self, chunk, part_path, offsets, lengths):
+        part = part_path[len(self.parent) + 1:] if part_path.startswith(self.parent) else part_path
+        if part not in self.part_ids:
+            self.part_ids[part] = len(self.parts)
+            self.parts.append(part)
+        entries = np.empty(len(chunk), dtype=INDEX_DTYPE)
+        entries['part'] = self.part_ids[part]
+        entries['offset'] = offsets
+        entries['length'] = lengths
+        for col in self.columns:
+            entries['key'] = get_row_keys(chunk, [col])
+            self.pending[col].append(entries.copy())
+        self.pending_rows += len(chunk)
+        if self.pending_rows * len(self.columns) >= index_memory_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+        base = strip_output_extension(self.file_path)
+        for col in self.columns:
+            entries = np.concatenate(self.pending[col])
+            run = entries[np.argsort(entries['key'], kind='stable')]
+            run_path = f"{base}_index_{col}_{len(self.runs[col]) + 1}.npy"
+            with open_output(run_path) as f:
+                np.save(f, run)
+            self.runs[col].append(os.path.basename(run_path))
+            self.pending[col] = []
+        self.pending_rows = 0
+
+    def close(self, output_end):
+        # Written last, so a run that did not finish leaves the index of the run before it in place.
+        # output_end is where the indexed rows end, which an incremental run checks before adding to the index.
+        self.flush()
+        index = {
+            'output_file': os.path.basename(self.file_path),
+            'format': output_format,
+            'columns': self.columns,
+            'parts': self.parts,
+            'runs': self.runs,
+            'output_end': output_end
+        }
+        index_path = get_key_index_path(self.file_path)
+        data = json.dumps(index, indent=1, default=str).encode('utf-8')
+        if is_s3_path(index_path):
+            with open_output(index_path) as f:
+                f.write(data)
+        else:
+            with open(index_path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(index_path + '.tmp', index_path)
+        logging.info(f"Key index saved to: {index_path}")
+
+
+def load_index_run(run_path):
+    # Local runs are memory mapped, so a lookup only reads the pages its binary search touches
+    if is_s3_path(run_path):
+        with open_source(run_path) as f:
+            return np.load(io.BytesIO(f.read()))
+    return np.load(run_path, mmap_mode='r')
+
+
+def read_indexed_rows(part_path, index_format, columns, entries):
+    # Reads only the rows the entries point at: byte ranges of a CSV part, row groups of a Parquet part
+    if index_format == 'parquet':
+        parquet_file = pq.ParquetFile(open_source(part_path) if is_s3_path(part_path) else part_path)
+        group_ends = np.cumsum([parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)])
+        rows = entries['offset'].astype(np.int64)
+        groups = np.searchsorted(group_ends, rows, side='right')
+        tables = []
+        for group in np.unique(groups):
+            group_start = group_ends[group - 1] if group else 0
+            table = parquet_file.read_row_group(int(group))
+            tables.append(table.take(pa.array(rows[groups == group] - group_start)))
+        return pa.concat_tables(tables).to_pandas()
+    lines = []
+    if is_s3_path(part_path):
+        for entry in entries:
+            with open_source(part_path, int(entry['length']), int(entry['offset'])) as f:
+                lines.append(f.read())
+    else:
+        with open(part_path, 'rb') as f:
+            for entry in entries:
+                f.seek(int(entry['offset']))
+                lines.append(f.read(int(entry['length'])))
+    return pd.read_csv(io.BytesIO(b''.join(lines)), sep='|', names=columns, header=None, dtype=str, keep_default_na=False)
+
+
+def lookup_rows(prefix, column, values):
+    # All rows of the prefix whose column matches one of values, from the key index of its latest output.
+    # Matching is on the 64-bit key hash, the same as dedup_keys.
+    manifest_state = load_prefix_manifest(prefix)
+    if manifest_state is None:
+        raise ValueError(f"No manifest for prefix {prefix} in {get_state_dir()}")
+    output_file = manifest_state['output_file']
+    index = load_key_index(output_file)
+    if index is None or column not in index['columns']:
+        raise ValueError(f"No key index on {column} for {output_file}")
+    parent = get_parent_path(output_file)
+    keys = np.unique(get_row_keys(pd.DataFrame({column: values}), [column]))
+    found = []
+    for run_name in index['runs'][column]:
+        run = load_index_run(join_output_path(parent, run_name))
+        run_keys = run['key']
+        for key in keys.tolist():
+            start = bisect.bisect_left(run_keys, key)
+            end = bisect.bisect_right(run_keys, key, lo=start)
+            if end > start:
+                found.append(np.array(run[start:end]))
+    if not found:
+        return pd.DataFrame(columns=manifest_state['columns'])
+    entries = np.concatenate(found)
+    entries = entries[np.lexsort((entries['offset'], entries['part']))]
+    frames = []
+    for part in np.unique(entries['part']):
+        part_path = join_output_path(parent, index['parts'][part])
+        frames.append(read_indexed_rows(part_path, index['format'], manifest_state['columns'], entries[entries['part'] == part]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_lookup():
+    # None when the lookup could not be made, e.g. the prefix has no manifest or key index
+    column, _, values = lookup_keys.partition('=')
+    lookup_start = time.perf_counter()
+    try:
+        rows = lookup_rows(lookup_prefix, column, values.split(','))
+    except (ValueError, OSError) as e:
+        logging.error(f"Lookup {lookup_keys} in prefix {lookup_prefix} failed: {e}")
+        return None
+    logging.info(f"Lookup {lookup_keys} in prefix {lookup_prefix} | {len(rows)} rows in "
+                 f"{(time.perf_counter() - lookup_start) * 1000:.1f} ms")
+    print(rows.to_csv(sep='|', index=False, lineterminator='\n'), end='')
+    return rows
+
+
+def open_compressed_stream(raw_handle, compression):
+    if compression == 'gzip':
+        level = 6 if compression_level is None else compression_level
+        return gzip.GzipFile(fileobj=raw_handle, mode='wb', compresslevel=level)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("output_compression 'zstd' needs the zstandard package installed")
+        level = 3 if compression_level is None else compression_level
+        compressor = zstandard.ZstdCompressor(level=level, threads=zstd_threads)
+        return compressor.stream_writer(raw_handle, closefd=False)
+    raise ValueError(f"Unknown output compression: {compression}")
+
+
+class ParquetPartWriter:
+    # Writes chunks into size bounded Parquet _partN files.
+    # Rollover is decided on bytes on disk: once the part gets within two chunks of MAX_FILE_SIZE_BYTES, the rows
+    # buffered so far are written out and each new chunk is written into memory once to measure its row groups.
+    # The footer is estimated on the safe side, so only a chunk larger than the limit on its own makes a larger part.
+    # All columns are stored as strings: parsed types differ between months and chunks
+    # (an empty column parses as float), while one Parquet file needs one schema.
+    # Dictionary encoding plus compression keeps the repeated text columns small.
+    def __init__(self, file_path, columns, start_part=1, checksum=False, track_rows=False):
+        if pq is None:
+            raise RuntimeError("output_format 'parquet' needs pyarrow installed")
+        self.file_path = file_path
+        self.checksum = checksum
+        self.track_rows = track_rows
+        self.row_offsets = None  # with track_rows: row number in the part of each row of the last chunk
+        self.schema = pa.schema([(col, pa.string()) for col in columns])
+        self.compression = None if parquet_compression == 'none' else parquet_compression
+        self.part = start_part - 1
+        self.sink = None
+        self.handle = None  # what the sink writes to, so a part cut off by an error can be aborted
+        self.hashing = None
+        self.writer = None
+        self.pending = []
+        self.pending_rows = 0
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.flushed_rows = 0
+        self.row_groups = 0
+        self.bytes_per_row = None  # most bytes per row of the row groups written into the part
+        self.footer_bytes_per_group = 200 * len(columns)  # raised to the most seen in a footer, never lowered
+        self.parts = []  # per part: rows, uncompressed (Arrow) bytes and bytes on disk
+
+    def open_part(self):
+        self.part += 1
+        part_path = get_part_filename(self.file_path, self.part)
+        if self.checksum:
+            self.hashing = HashingWriter(open_output(part_path))
+            self.handle = self.hashing
+            self.sink = pa.PythonFile(self.handle, mode='w')
+        elif is_s3_path(part_path):
+            self.handle = open_output(part_path)
+            self.sink = pa.PythonFile(self.handle, mode='w')
+        else:
+            self.sink = pa.OSFile(part_path, 'wb')
+            self.handle = self.sink
+        self.writer = pq.ParquetWriter(self.sink, self.schema, compression=self.compression)
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.flushed_rows = 0
+        self.row_groups = 0
+        self.parts.append({'part': self.part, 'path': part_path, 'rows': 0, 'data_bytes': 0, 'file_bytes': 0})
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.writer.write_table(pa.concat_tables(self.pending), row_group_size=parquet_row_group_rows)
+        written = self.sink.tell() - self.part_bytes
+        self.bytes_per_row = max(self.bytes_per_row if self.flushed_rows else 0.0, written / self.pending_rows)
+        self.part_bytes += written
+        self.flushed_rows += self.pending_rows
+        self.row_groups += -(-self.pending_rows // parquet_row_group_rows)
+        self.pending = []
+        self.pending_rows = 0
+
+    def close_part(self):
+        self.flush()
+        self.writer.close()
+        footer_bytes = self.sink.tell() - self.part_bytes
+        self.footer_bytes_per_group = max(self.footer_bytes_per_group, footer_bytes / max(self.row_groups, 1))
+        self.parts[-1].update(rows=self.part_rows, file_bytes=self.sink.tell())
+        self.sink.close()
+        if self.checksum:
+            self.parts[-1].update(self.hashing.checksums())
+            write_checksum_file(self.parts[-1]['path'], self.parts[-1]['sha256'])
+        self.writer = None
+
+    def estimate_bytes(self, rows):
+        # Size of the part once rows more are written and it is closed
+        buffered_rows = self.pending_rows + rows
+        return (self.part_bytes + buffered_rows * self.bytes_per_row
+                + (self.row_groups + 1 + buffered_rows // parquet_row_group_rows) * self.footer_bytes_per_group)
+
+    def measure_bytes(self, table):
+        # Bytes the table's row groups take in a part, from writing it into a Parquet file in memory.
+        # That file's footer has few row groups to share its fixed part, so it also raises footer_bytes_per_group.
+        buffer = pa.BufferOutputStream()
+        with pq.ParquetWriter(buffer, self.schema, compression=self.compression) as writer:
+            writer.write_table(table, row_group_size=parquet_row_group_rows)
+        data = buffer.getvalue()
+        footer_bytes = pq.read_metadata(pa.BufferReader(data)).serialized_size + 8  # footer length and magic
+        row_groups = -(-table.num_rows // parquet_row_group_rows)
+        self.footer_bytes_per_group = max(self.footer_bytes_per_group, footer_bytes / row_groups)
+        return data.size - 4 - footer_bytes, row_groups
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk.astype('string'), schema=self.schema, preserve_index=False)
+        if self.bytes_per_row is None:
+            self.bytes_per_row = table.nbytes / max(len(chunk), 1)  # uncompressed size until a row group is on disk
+        # The part is chosen when the chunk is accepted, so the row range reported for it stays true after buffering
+        if self.writer is None:
+            self.open_part()
+        elif self.part_rows and self.estimate_bytes(2 * len(chunk)) > MAX_FILE_SIZE_BYTES:
+            self.flush()
+            chunk_bytes, chunk_groups = self.measure_bytes(table)
+            if self.part_bytes + chunk_bytes + (self.row_groups + chunk_groups) * self.footer_bytes_per_group > MAX_FILE_SIZE_BYTES:
+                self.close_part()
+                self.open_part()
+        self.pending.append(table)
+        self.parts[-1]['data_bytes'] += table.nbytes
+        self.pending_rows += len(chunk)
+        self.part_rows += len(chunk)
+        if self.track_rows:
+            self.row_offsets = np.arange(self.part_rows - len(chunk), self.part_rows, dtype=np.uint64)
+            self.row_lengths = np.zeros(len(chunk), dtype=np.uint32)
+        if self.pending_rows >= parquet_row_group_rows:
+            self.flush()
+
+    def abort(self):
+        # The open part is not completed: the writer finishes into the sink, then an S3 upload is aborted instead
+        # of completed. A local part is left as it is, which the next incremental run rebuilds.
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+        finally:
+            self.writer = None
+            abort_output(self.handle)
+
+    def close(self):
+        if self.writer is not None:
+            self.close_part()
+
+
+def get_row_positions(chunk, data, start):
+    # Byte offset and length of every row rendered into data, which starts at byte start of the part.
+    # A quoted value with a line break spans two lines; such chunks are measured row by row.
+    line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n')) + 1
+    if len(line_ends) == len(chunk):
+        lengths = np.diff(line_ends, prepend=0)
+    else:
+        lengths = np.array([len(chunk.iloc[i:i+1].to_csv(header=False, sep='|', index=False, lineterminator='\n').encode('utf-8'))
+                            for i in range(len(chunk))])
+    offsets = start + np.cumsum(lengths) - lengths
+    return offsets.astype(np.uint64), lengths.astype(np.uint32)
+
+
+class CsvPartWriter:
+    # Writes pipe delimited chunks into _partN files through one open binary handle per part.
+    # Each chunk is rendered straight to bytes once and streamed through the optional gzip/zstd compressor.
+    # Rollover is decided on bytes on disk: the compressor is flushed after every chunk and the next chunk
+    # is estimated with the worst compression ratio seen in the part.
+    # With rolling=False there is no rollover and file_path itself is written (used for the run logs).
+    def __init__(self, file_path, columns, resume=None, rolling=True, compression='none', checksum=False, track_rows=False):
+        self.file_path = file_path
+        self.rolling = rolling
+        self.compression = compression
+        self.checksum = checksum
+        self.track_rows = track_rows
+        self.row_offsets = None  # with track_rows: byte offset in the part and length of each row of the last chunk
+        self.row_lengths = None
+        self.header = pd.DataFrame(columns=columns).to_csv(sep='|', index=False, lineterminator='\n').encode('utf-8')
+        self.raw_handle = None
+        self.stream = None
+        self.part = 0
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.part_ratio = 1.0
+        self.parts = []  # per part: rows, uncompressed bytes and bytes on disk
+        if resume is not None:
+            # Continue the last part of an earlier run, cut back to the end of its last completed file
+            self.part = resume['part']
+            self.raw_handle = open(self.part_path(), 'r+b', buffering=1024*1024)
+            self.raw_handle.truncate(resume['bytes'])
+            self.raw_handle.seek(resume['bytes'])
+            if checksum:
+                hash_state = resume.get('hash_state') or get_hash_state(self.part_path(), resume['bytes'])
+                self.raw_handle = HashingWriter(self.raw_handle, hash_state)
+            self.stream = self.raw_handle
+            self.part_rows = resume['rows']
+            self.part_bytes = resume['bytes']
+            self.parts.append({'part': self.part, 'path': self.part_path(), 'rows': self.part_rows, 'data_bytes': self.part_bytes,
+                               'file_bytes': self.part_bytes, 'resumed_rows': self.part_rows})
+
+    def part_path(self):
+        return get_part_filename(self.file_path, self.part) if self.rolling else self.file_path
+
+    def close_part(self):
+        self.stream.close()
+        if self.stream is not self.raw_handle:
+            self.parts[-1]['file_bytes'] = self.raw_handle.tell()
+        if self.stream is not self.raw_handle:
+            self.raw_handle.close()
+            # Compressed parts only get their final name once the stream is complete (S3 parts already do)
+            if not is_s3_path(self.part_path()):
+                os.replace(self.part_path() + '.partial', self.part_path())
+        if self.checksum:
+            self.parts[-1].update(self.raw_handle.checksums())
+            write_checksum_file(self.part_path(), self.parts[-1]['sha256'])
+            if self.stream is self.raw_handle and not is_s3_path(self.part_path()):
+                part_hash_states[self.part_path()] = (self.part_bytes, self.raw_handle.state())
+        self.raw_handle = None
+        self.stream = None
+
+    def open_part(self):
+        if self.raw_handle is not None:
+            self.close_part()
+        self.part += 1
+        if self.compression == 'none' or is_s3_path(self.part_path()):
+            self.raw_handle = open_output(self.part_path())
+        else:
+            self.raw_handle = open_output(self.part_path() + '.partial')
+        if self.checksum:
+            self.raw_handle = HashingWriter(self.raw_handle)
+        if self.compression == 'none':
+            self.stream = self.raw_handle
+        else:
+            self.stream = open_compressed_stream(self.raw_handle, self.compression)
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.part_ratio = 1.0
+        self.parts.append({'part': self.part, 'path': self.part_path(), 'rows': 0, 'data_bytes': 0, 'file_bytes': 0})
+        self.write_bytes(self.header)
+
+    def write_bytes(self, data):
+        self.stream.write(data)
+        # Flushed per chunk so the bytes on disk are known and the offsets recorded in the manifest are written
+        self.stream.flush()
+        if self.stream is not self.raw_handle:
+            self.raw_handle.flush()
+        written = self.raw_handle.tell() - self.part_bytes
+        if len(data):
+            self.part_ratio = max(self.part_ratio if self.part_rows else 0.0, written / len(data))
+        self.part_bytes += written
+        self.parts[-1]['data_bytes'] += len(data)
+        self.parts[-1]['file_bytes'] = self.part_bytes
+
+    def write(self, chunk):
+        buffer = io.BytesIO()
+        chunk.to_csv(buffer, mode='wb', header=False, sep='|', index=False, lineterminator='\n', encoding='utf-8')
+        data = buffer.getbuffer()
+        if self.raw_handle is None:
+            self.open_part()
+        elif self.rolling and self.part_rows and self.part_bytes + len(data) * self.part_ratio > MAX_FILE_SIZE_BYTES:
+            self.open_part()
+        if self.track_rows:
+            self.row_offsets, self.row_lengths = get_row_positions(chunk, data, self.part_bytes)
+        self.write_bytes(data)
+        self.part_rows += len(chunk)
+        self.parts[-1]['rows'] = self.part_rows
+        del data
+        buffer.close()
+
+    def abort(self):
+        # The open part is not completed: an S3 upload is aborted, a compressed part keeps its .partial name and an
+        # uncompressed local part keeps the rows written so far, which a resumed run cuts back to its last file.
+        if self.raw_handle is None:
+            return
+        try:
+            if self.stream is not self.raw_handle:
+                self.stream.close()
+        finally:
+            abort_output(self.raw_handle)
+            self.raw_handle = None
+            self.stream = None
+
+    def close(self):
+        if self.raw_handle is not None:
+            self.close_part()
+
+
+part_hash_states = {}  # checksum state of the uncompressed CSV parts this process closed, by part path
+
+
+def get_hash_state(part_path, length):
+    # Checksum state of the first length bytes of a part, read back once so a resumed part can be appended to
+    hashing = HashingWriter(open(os.devnull, 'wb'))
+    with open(part_path, 'rb') as f:
+        while length > 0:
+            data = f.read(min(length, 8*1024*1024))
+            if not data:
+                break
+            hashing.write(data)
+            length -= len(data)
+    hashing.close()
+    return hashing.state()
+
+
+def create_part_writer(file_path, expected_cols, resume=None, last_part=0, checksum=False, track_rows=False):
+    # resume continues the last part of an earlier run, cut back to its last completed file; closed Parquet,
+    # compressed and S3 parts cannot be appended to, so those start at the part after last_part.
+    # Checksums of a resumed part carry on from the state saved when this process closed it (watch mode),
+    # otherwise from the kept bytes read back once.
+    if not is_s3_path(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    if output_format == 'parquet':
+        return ParquetPartWriter(file_path, expected_cols, last_part + 1, checksum, track_rows)
+    if resume is not None and output_compression == 'none' and not is_s3_path(file_path):
+        if checksum:
+            hash_bytes, hash_state = part_hash_states.get(get_part_filename(file_path, resume['part']), (None, None))
+            resume = dict(resume, hash_state=hash_state if hash_bytes == resume['bytes'] else None)
+        return CsvPartWriter(file_path, expected_cols, resume, checksum=checksum, track_rows=track_rows)
+    writer = CsvPartWriter(file_path, expected_cols, compression=output_compression, checksum=checksum, track_rows=track_rows)
+    writer.part = last_part
+    return writer
+
+
+def save_chunks(chunks, file_path, expected_cols, output_position=None, resume=None, stage_times=None, stats_columns=None,
+                key_index=None):
+    # output_position is updated after every chunk so the caller can record where each file's rows went.
+    # stage_times, when given, accumulates the seconds spent aligning columns and writing.
+    # In the hive layout every period gets its own part series in a period= folder next to file_path, parts carry
+    # the min/max of stats_columns, and a resumed run starts new parts in every period.
+    # key_index, when given, is fed the part and position of every row written.
+    # Returns rows and sizes per part written.
+    if stage_times is None:
+        stage_times = {'align': 0.0, 'write': 0.0}
+    hive = output_layout == 'hive'
+    parts = []
+    writer = None
+    writer_period = None
+    last_parts = {}  # hive: last part number written per period, so a period seen again continues its numbering
+    if hive:
+        for part in (resume or {}).get('parts', []):
+            last_parts[part['period']] = max(last_parts.get(part['period'], 0), part['part'])
+    else:
+        writer = create_part_writer(file_path, expected_cols, resume, resume['part'] if resume is not None else 0,
+                                    part_checksums, key_index is not None)
+    try:
+        for chunk in chunks:
+            align_start = time.perf_counter()
+            chunk = chunk.reindex(columns=expected_cols, fill_value=" ")  # as before streaming: " " marks a column the file lacks
+            write_start = time.perf_counter()
+            if hive and chunk['period'].iat[0] != writer_period:
+                # Chunks never mix periods: every source file belongs to one monthly folder
+                if writer is not None:
+                    writer.close()
+                    parts.extend(dict(part, period=writer_period) for part in writer.parts)
+                writer_period = chunk['period'].iat[0]
+                writer = create_part_writer(get_partition_path(file_path, writer_period), expected_cols,
+                                            last_part=last_parts.get(writer_period, 0), checksum=part_checksums,
+                                            track_rows=key_index is not None)
+            writer.write(chunk)
+            if key_index is not None:
+                key_index.add(chunk, writer.parts[-1]['path'], writer.row_offsets, writer.row_lengths)
+            if stats_columns:
+                update_part_stats(writer.parts[-1], chunk, stats_columns)
+            stage_times['align'] += write_start - align_start
+            stage_times['write'] += time.perf_counter() - write_start
+            if hive:
+                last_parts[writer_period] = writer.part
+            if output_position is not None:
+                output_position.update(part=writer.part, rows=writer.part_rows, bytes=writer.part_bytes)
+                if hive:
+                    output_position['period'] = writer_period
+    except BaseException:
+        # Also on Ctrl-C: a part cut off half way is aborted, so no truncated S3 object is published
+        if writer is not None:
+            writer.abort()
+        raise
+    close_start = time.perf_counter()
+    if writer is not None:
+        writer.close()
+        parts.extend(dict(part, period=writer_period) if hive else part for part in writer.parts)
+    stage_times['write'] += time.perf_counter() - close_start
+    return parts
+
+
+def save_log(df, file_path):
+    writer = CsvPartWriter(file_path, list(df.columns), rolling=False)
+    try:
+        writer.write(df)
+    finally:
+        writer.close()
+
+
+def read_prefix_file(prefix_file, compactor=None):
+    if should_split(prefix_file):
+        chunks = read_byte_ranges(prefix_file, streaming_chunk_rows)
+    else:
+        chunks = read_csv_chunks(prefix_file['file_path'], prefix_file['dialect'], streaming_chunk_rows, prefix_file,
+                                 prefix_file['dtypes'], prefix_file['columns'], prefix_file.get('usecols'))
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        chunk['period'] = prefix_file['period']
+        if compactor is not None:
+            chunk = compactor.compact(chunk)
+        yield chunk
+
+
+def put_until_stopped(chunk_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            chunk_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def read_file_into_queue(prefix_file, chunk_queue, stop_event, compactor=None):
+    try:
+        for chunk in read_prefix_file(prefix_file, compactor):
+            if stop_event.is_set():
+                return
+            put_until_stopped(chunk_queue, ('chunk', chunk), stop_event)
+        put_until_stopped(chunk_queue, ('done', None), stop_event)
+    except Exception as e:
+        put_until_stopped(chunk_queue, ('error', e), stop_event)
+
+
+def drain_chunk_queue(chunk_queue):
+    while True:
+        kind, item = chunk_queue.get()
+        if kind == 'done':
+            return
+        if kind == 'error':
+            raise item
+        yield item
+
+
+def read_files_concurrently(prefix_files, compactor=None):
+    # Files are read by read_workers threads but handed out in input order, so output matches the serial run.
+    # Each file gets a bounded queue, which caps memory at about read_workers * read_queue_chunks chunks.
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=read_workers)
+    try:
+        chunk_queues = []
+        for prefix_file in prefix_files:
+            chunk_queue = queue.Queue(maxsize=read_queue_chunks)
+            executor.submit(read_file_into_queue, prefix_file, chunk_queue, stop_event, compactor)
+            chunk_queues.append(chunk_queue)
+        for prefix_file, chunk_queue in zip(prefix_files, chunk_queues):
+            yield prefix_file, drain_chunk_queue(chunk_queue)
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_manifest_path(prefix):
+    return os.path.join(get_state_dir(), 'manifest', f"{prefix}.jsonl")
+
+
+def append_manifest_record(manifest_path, record):
+    # One line per record, flushed to disk, so a crash leaves at most a torn last line
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, 'ab') as f:
+        if f.tell() > 0:
+            with open(manifest_path, 'rb') as check:
+                check.seek(-1, os.SEEK_END)
+                if check.read(1) != b'\n':
+                    f.write(b'\n')  # start after a line torn by an earlier crash
+        f.write((json.dumps(record, default=str) + '\n').encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_prefix_manifest(prefix):
+    # Returns the latest output started for the prefix and the files completed into it
+    manifest_path = get_manifest_path(prefix)
+    if not os.path.exists(manifest_path):
+        return None
+    state = None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # torn line from an interrupted run
+            if record['record_type'] == 'output':
+                state = {'output_file': record['output_file'], 'columns': record['columns'], 'layout': record.get('layout', 'flat'),
+                         'filters': record.get('filters', []), 'files': {}, 'last_file': None}
+            elif state is not None:
+                state['files'][record['file_location']] = record
+                if record['record_type'] == 'file':
+                    state['last_file'] = record
+    return state
+
+
+def stat_matches(prefix_matches):
+    # Size and mtime of the matched local files as they are now. The cached source listing only rescans folders whose
+    # mtime changed, and a file overwritten in place leaves its folder's mtime alone. Files gone since are dropped.
+    matches = []
+    for match in prefix_matches:
+        if is_s3_path(match['file_path']):
+            matches.append(match)  # S3 folders are listed afresh every run
+            continue
+        try:
+            file_stats = os.stat(match['file_path'])
+        except OSError:
+            continue
+        matches.append(dict(match, file_size=file_stats.st_size, file_mtime=file_stats.st_mtime_ns))
+    return matches
+
+
+def is_unchanged(prefix_file, manifest_record):
+    return (manifest_record['file_size_bytes'] == prefix_file['file_size']
+            and manifest_record['file_mtime'] == prefix_file['file_mtime'])
+
+
+def plan_resume(prefix, prefix_matches, manifest_state):
+    # Returns the files still to consolidate and where to resume writing, or None for a fresh output
+    if manifest_state is None or manifest_state['last_file'] is None:
+        return prefix_matches, None
+    if not manifest_state['output_file'].endswith(get_output_extension()) or manifest_state['layout'] != output_layout:
+        logging.info(f"Output format of prefix {prefix} changed since the last run, rebuilding")
+        return prefix_matches, None
+    current = {match['file_path']: match for match in prefix_matches}
+    for file_path, record in manifest_state['files'].items():
+        if file_path not in current or not is_unchanged(current[file_path], record):
+            logging.info(f"{file_path} changed or was removed since the last run, rebuilding prefix {prefix}")
+            return prefix_matches, None
+    output_end = manifest_state['last_file']['output_end']
+    pending = [match for match in prefix_matches if match['file_path'] not in manifest_state['files']]
+    key_columns = get_index_columns(prefix)
+    index_state = None
+    if key_columns:
+        # An index behind the run manifest (a run that did not finish) would miss the rows written after it
+        index_state = load_key_index(manifest_state['output_file'])
+        if index_state is None or index_state['columns'] != key_columns or index_state['output_end'] != output_end:
+            logging.info(f"Key index of prefix {prefix} is missing or behind the run manifest, rebuilding")
+            return prefix_matches, None
+    if output_layout == 'hive':
+        # The part manifest is only written once a run completes, so it also tells whether the last run finished
+        part_manifest = load_part_manifest(manifest_state['output_file'])
+        last_parts = [part for part in (part_manifest or {}).get('parts', [])
+                      if part['period'] == output_end['period'] and part['part'] == output_end['part']]
+        if not last_parts or last_parts[0]['rows'] < output_end['rows']:
+            logging.info(f"Part manifest of prefix {prefix} is missing or behind the run manifest, rebuilding")
+            return prefix_matches, None
+        parent = get_parent_path(manifest_state['output_file'])
+        parts = [dict(part, path=join_output_path(parent, part['path'])) for part in part_manifest['parts']]
+        return pending, dict(output_end, output_file=manifest_state['output_file'], parts=parts, index=index_state)
+    last_part = get_part_filename(manifest_state['output_file'], output_end['part'])
+    last_part_size = get_path_size(last_part)
+    if last_part_size is None or last_part_size < output_end['bytes']:
+        logging.info(f"Output part {output_end['part']} of prefix {prefix} is missing or incomplete, rebuilding")
+        return prefix_matches, None
+    if last_part.endswith('.parquet') and not is_s3_path(last_part):
+        # A Parquet part cut off by a crash has no footer and cannot be repaired (an S3 upload is never left half written)
+        try:
+            pq.ParquetFile(last_part)
+        except Exception:
+            logging.info(f"Output part {output_end['part']} of prefix {prefix} was not closed, rebuilding")
+            return prefix_matches, None
+        # More rows: rows of an interrupted file. Fewer: rows still buffered when a failed run aborted the part
+        if pq.ParquetFile(last_part).metadata.num_rows != output_end['rows']:
+            logging.info(f"Output part {output_end['part']} of prefix {prefix} does not hold the rows in the run manifest, rebuilding")
+            return prefix_matches, None
+    # A file interrupted after a rollover left rows in a part that was closed; Parquet and compressed parts cannot
+    # be cut back like an uncompressed CSV part, and the next part would keep rows too, so the prefix is rebuilt
+    if is_part_started(get_part_filename(manifest_state['output_file'], output_end['part'] + 1)):
+        logging.info(f"Output of prefix {prefix} goes on past the end recorded in the run manifest, rebuilding")
+        return prefix_matches, None
+    return pending, dict(output_end, output_file=manifest_state['output_file'], index=index_state)
+
+
+def stream_prefix_chunks(prefix_files, metadata_log, prefix_stats, output_position=None, manifest_path=None, stage_times=None,
+                         key_set=None, compactor=None):
+    # Yields each file chunk by chunk so only one chunk per file is held in memory.
+    # The writer has saved a chunk by the time this generator is resumed, so output_position then shows where it went
+    # and stage_times includes its align and write time. Read time is the time spent waiting for the next chunk.
+    # Rows not matching the file's row_filters are dropped first; key_set, when given, then drops rows whose key was already seen.
+    # compactor, when given, shrinks the dtypes of every chunk as it is read; that time counts as read time.
+    if stage_times is None:
+        stage_times = {'align': 0.0, 'write': 0.0}
+    if read_workers > 1:
+        file_chunks = read_files_concurrently(prefix_files, compactor)
+    else:
+        file_chunks = ((prefix_file, read_prefix_file(prefix_file, compactor)) for prefix_file in prefix_files)
+
+    for prefix_file, chunks in file_chunks:
+        period, file_path = prefix_file['period'], prefix_file['file_path']
+        file_rows = 0
+        output_parts = []
+        file_start = time.perf_counter()
+        rss_start = get_rss_bytes()
+        stages_start = dict(stage_times)
+        read_seconds = 0.0
+        filtered_rows = 0
+        duplicate_rows = 0
+        try:
+            chunk_iter = iter(chunks)
+            while True:
+                read_start = time.perf_counter()
+                chunk = next(chunk_iter, None)
+                read_seconds += time.perf_counter() - read_start
+                if chunk is None:
+                    break
+                file_rows += len(chunk)
+                if prefix_file.get('row_filters'):
+                    read_rows = len(chunk)
+                    chunk = apply_row_filters(chunk, prefix_file['row_filters'])
+                    filtered_rows += read_rows - len(chunk)
+                    if chunk.empty:
+                        continue
+                if key_set is not None:
+                    read_rows = len(chunk)
+                    chunk = key_set.drop_seen(chunk)
+                    duplicate_rows += read_rows - len(chunk)
+                    if chunk.empty:
+                        continue
+                yield chunk
+                rss = get_rss_bytes()
+                if rss is not None:
+                    prefix_stats['peak_rss'] = max(prefix_stats.get('peak_rss') or 0, rss)
+                if output_position:
+                    first_row = output_position['rows'] - len(chunk)
+                    if output_parts and output_parts[-1][0] == output_position['part']:
+                        output_parts[-1][2] += len(chunk)
+                    else:
+                        output_parts.append([output_position['part'], first_row, len(chunk)])
+            if file_rows == 0:
+                raise ValueError("File is empty")
+        except Exception as e:
+            if file_rows:
+                logging.error(f"Error reading {file_path} after {file_rows} rows were written: {e}")
+            else:
+                logging.error(f"Error reading {file_path}: {e}")
+            continue
+
+        file_seconds = time.perf_counter() - file_start
+        rss_end = get_rss_bytes()
+        file_size = round(prefix_file['file_size']/1024,2) # in KB, from the source index
+        metadata_log.append({
+            'file_name':os.path.basename(file_path),
+            'file_location':file_path,
+            'month':period,
+            'row_count':file_rows,
+            'col_count':len(prefix_file['columns']),
+            'missing_columns':','.join(prefix_file['missing_columns']),
+            'file_size_KB':file_size,
+            'delimiter':DELIMITER_NAMES[prefix_file['dialect']['sep']],
+            'encoding':prefix_file.get('encoding'),
+            'content_hash':prefix_file.get('content_hash'),
+            'duplicate_of':None,
+            'filtered_rows':filtered_rows,
+            'duplicate_rows':duplicate_rows,
+            'header_seconds':round(prefix_file.get('header_seconds', 0.0), 4),
+            'read_seconds':round(read_seconds, 4),
+            'align_seconds':round(stage_times['align'] - stages_start['align'], 4),
+            'write_seconds':round(stage_times['write'] - stages_start['write'], 4),
+            'rows_per_sec':round(file_rows / file_seconds, 1) if file_seconds else None,
+            'bytes_per_sec':round(prefix_file['file_size'] / file_seconds, 1) if file_seconds else None,
+            'rss_delta_MB':to_mb(rss_end - rss_start) if rss_start is not None and rss_end is not None else None,
+            'timestamp':datetime.now()
+        })
+        if manifest_path:
+            append_manifest_record(manifest_path, dict(
+                metadata_log[-1],
+                record_type='file',
+                file_size_bytes=prefix_file['file_size'],
+                file_mtime=prefix_file['file_mtime'],
+                dialect=prefix_file['dialect'],
+                columns=prefix_file['columns'],
+                output_parts=output_parts,  # [part, first data row, row count]
+                output_end=dict(output_position)
+            ))
+        prefix_stats['total_files'] += 1
+        prefix_stats['total_rows'] += file_rows
+        prefix_stats['filtered_rows'] += filtered_rows
+        prefix_stats['duplicate_rows'] += duplicate_rows
+        prefix_stats['periods'].add(period)
+        prefix_stats['read_seconds'] += read_seconds
+        record = metadata_log[-1]
+        logging.info(f"Appended: {file_path} | {file_rows} rows | {filtered_rows} filtered rows | {duplicate_rows} duplicate rows | read {record['read_seconds']:.2f}s | "
+                     f"align {record['align_seconds']:.2f}s | write {record['write_seconds']:.2f}s | "
+                     f"{record['rows_per_sec'] or 0:,.0f} rows/s | RSS delta {record['rss_delta_MB']} MB")
+
+
+def plan_prefix_schema(prefix, monthly_folders, prefix_matches, completed_files=None):
+    # Reads only the header line of each matched file, so the output schema, the canonical column order
+    # and each file's missing columns are known before any data is parsed
+    completed_files = completed_files or {}
+    prefix_files = []
+    all_columns = set()
+    expected_cols = []
+    prefix_dialect = None  # every month's file of a prefix has the same layout, so the first detection is reused
+    dtypes = get_prefix_dtypes(prefix)
+
+    for folder in monthly_folders:
+        period = os.path.basename(folder)
+        matched_files = [match for match in prefix_matches if match['period'] == period]
+        
+        if not matched_files:
+            logging.info(f"No files for prefix '{prefix}' in folder '{period}'")
+            continue
+
+        for match in matched_files:
+            file_path = match['file_path']
+            if file_path in completed_files:
+                dialect, columns = completed_files[file_path]['dialect'], completed_files[file_path]['columns']
+            else:
+                try:
+                    if prefix_dialect is None:
+                        prefix_dialect = detect_dialect(file_path)
+                        logging.info(f"Detected {DELIMITER_NAMES[prefix_dialect['sep']]} delimited "
+                                     f"{prefix_dialect['encoding']} files for prefix {prefix} from {file_path}")
+                    header_start = time.perf_counter()
+                    dialect, columns = prefix_dialect, read_csv_header(file_path, prefix_dialect)
+                    match = dict(match, header_seconds=time.perf_counter() - header_start)
+                except Exception as e:
+                    logging.error(f"Error reading {file_path}: {e}")
+                    continue
+            all_columns.add(tuple(columns))  #track column structure
+            expected_cols += [col for col in columns if col != 'period' and col not in expected_cols]
+            prefix_files.append(dict(match, dialect=dialect, columns=columns, dtypes=dtypes))
+
+    keep_columns, row_filters = get_prefix_job(prefix)
+    if keep_columns is not None:
+        # Only the kept columns are written, in the job's order. The parser also reads the filter and dedup key
+        # columns, which are dropped again when the chunk is aligned to the output columns.
+        missing = [col for col in keep_columns if col not in expected_cols]
+        if missing and prefix_files:
+            logging.warning(f"Job columns {', '.join(missing)} of prefix {prefix} are in none of its files")
+        expected_cols = [col for col in keep_columns if col in expected_cols and col != 'period']
+        parse_columns = set(expected_cols) | {row_filter[0] for row_filter in row_filters}
+        parse_columns |= set(get_prefix_setting(dedup_keys, prefix, None) or [])
+        for prefix_file in prefix_files:
+            prefix_file['usecols'] = [col for col in prefix_file['columns'] if col in parse_columns]
+    expected_cols = expected_cols + ['period']
+    for prefix_file in prefix_files:
+        present = set(prefix_file['columns'])
+        prefix_file['missing_columns'] = [col for col in expected_cols if col != 'period' and col not in present]
+        prefix_file['row_filters'] = row_filters
+    return prefix_files, expected_cols, all_columns
+
+
+def write_schema_report(prefixes, monthly_folders, prefix_matches):
+    # Column mismatch report from the header lines only, no data is parsed
+    report = []
+    for prefix, matches in zip(prefixes, prefix_matches):
+        prefix_files, expected_cols, all_columns = plan_prefix_schema(prefix, monthly_folders, matches)
+        for prefix_file in prefix_files:
+            report.append({
+                'prefix':prefix,
+                'file_name':os.path.basename(prefix_file['file_path']),
+                'file_location':prefix_file['file_path'],
+                'month':prefix_file['period'],
+                'col_count':len(prefix_file['columns']),
+                'prefix_col_count':len(expected_cols) - 1,
+                'column_mismatch_flag':len(all_columns) > 1,
+                'missing_columns':','.join(prefix_file['missing_columns']),
+                'column_order_differs':[col for col in expected_cols if col in prefix_file['columns']] != prefix_file['columns']
+            })
+    if report:
+        report_file_path = get_output_path(f"schema_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        save_log(pd.DataFrame(report), report_file_path)
+        logging.info(f"Schema report saved to: {report_file_path}")
+    else:
+        logging.warning("No files found for the schema report")
+
+
+def count_file_lines(file_path):
+    # Counts line breaks and hashes the same bytes in 4MB blocks. Plain reads rather than mmap: reads and hashing
+    # release the GIL, so audit threads overlap, while mmap page faults would be taken with the GIL held.
+    # These are physical lines, so a quoted field holding a line break counts twice.
+    hasher = hashlib.blake2b(digest_size=16)  # same hash as HashingReader, so audit and consolidation logs compare
+    buffer = bytearray(4*1024*1024)
+    view = memoryview(buffer)
+    lines = 0
+    last_byte = b'\n'
+    with open_source(file_path) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+            lines += buffer.count(b'\n', 0, size)
+            last_byte = buffer[size - 1:size]
+    if last_byte != b'\n':
+        lines += 1  # last line without a line break
+    return lines, hasher.hexdigest()
+
+
+def write_audit_log(prefixes, monthly_folders, prefix_matches):
+    # Master log columns from the source index (sizes), the header line (columns) and a line count (rows).
+    # Files whose header differs from the prefix's most common header are flagged.
+    audit_start = time.perf_counter()
+    planned = [(prefix,) + plan_prefix_schema(prefix, monthly_folders, matches)[:2]
+               for prefix, matches in zip(prefixes, prefix_matches)]
+    file_paths = [prefix_file['file_path'] for prefix, prefix_files, expected_cols in planned for prefix_file in prefix_files]
+    with ThreadPoolExecutor(max_workers=audit_workers) as executor:
+        line_counts = dict(zip(file_paths, executor.map(count_file_lines, file_paths)))
+
+    audit_log = []
+    total_bytes = 0
+    for prefix, prefix_files, expected_cols in planned:
+        if not prefix_files:
+            logging.warning(f"No files found for prefix: {prefix}")
+            continue
+        dominant = Counter(tuple(prefix_file['columns']) for prefix_file in prefix_files).most_common(1)[0][0]
+        prefix_rows = 0
+        mismatches = 0
+        for prefix_file in prefix_files:
+            file_path, columns = prefix_file['file_path'], prefix_file['columns']
+            lines, content_hash = line_counts[file_path]
+            schema_mismatch = tuple(columns) != dominant
+            if schema_mismatch:
+                mismatches += 1
+                logging.warning(f"{file_path} does not match the usual header of prefix {prefix}")
+            audit_log.append({
+                'file_name':os.path.basename(file_path),
+                'file_location':file_path,
+                'month':prefix_file['period'],
+                'row_count':max(lines - 1, 0),
+                'col_count':len(columns),
+                'missing_columns':','.join(prefix_file['missing_columns']),
+                'file_size_KB':round(prefix_file['file_size']/1024,2),
+                'delimiter':DELIMITER_NAMES[prefix_file['dialect']['sep']],
+                'encoding':prefix_file['dialect']['encoding'],  # from the prefix sample, the files are not decoded
+                'content_hash':content_hash,
+                'schema_mismatch':schema_mismatch,
+                # against the usual header; a mismatch with no differences is a change of column order
+                'schema_differences':','.join([f"+{col}" for col in columns if col not in dominant]
+                                              + [f"-{col}" for col in dominant if col not in columns]),
+                'timestamp':datetime.now()
+            })
+            prefix_rows += audit_log[-1]['row_count']
+            total_bytes += prefix_file['file_size']
+        logging.info(f"Audit {prefix} | {len(prefix_files)} files | {prefix_rows} rows | "
+                     f"{len(expected_cols) - 1} columns | {mismatches} files off the usual header")
+
+    if audit_log:
+        audit_seconds = time.perf_counter() - audit_start
+        audit_file_path = get_output_path(f"audit_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        save_log(pd.DataFrame(audit_log), audit_file_path)
+        logging.info(f"Audited {len(audit_log)} files, {to_mb(total_bytes)} MB in {audit_seconds:.2f}s "
+                     f"({to_mb(total_bytes / max(audit_seconds, 1e-9))} MB/s)")
+        logging.info(f"Audit log saved to: {audit_file_path}")
+    else:
+        logging.warning("No files found for the audit log")
+
+
+def hash_file(file_path):
+    hasher = hashlib.sha256()
+    buffer = bytearray(4*1024*1024)
+    view = memoryview(buffer)
+    with open_source(file_path) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+
+def verify_part(checksum_path):
+    verify_start = time.perf_counter()
+    part_path = checksum_path[:-len('.sha256')]
+    with open_source(checksum_path) as f:
+        expected = f.read().decode('utf-8').split()[0]
+    try:
+        actual = hash_file(part_path)
+    except (OSError, ValueError) as e:
+        logging.error(f"Error reading {part_path}: {e}")
+        actual = None
+    return {
+        'part_file': part_path,
+        'expected_sha256': expected,
+        'actual_sha256': actual,
+        'verified': actual == expected,
+        'file_size_KB': round((get_path_size(part_path) or 0) / 1024, 2),
+        'seconds': round(time.perf_counter() - verify_start, 3),
+        'timestamp': datetime.now()
+    }
+
+
+def verify_part_checksums():
+    # Checks every part under the output dir against its .sha256 file, audit_workers parts at a time
+    verify_start = time.perf_counter()
+    if is_s3_path(local_output_dir):
+        paths = [path for _, path, _, _ in list_s3_files(get_s3(), local_output_dir)]
+    else:
+        paths = [os.path.join(folder, name) for folder, _, names in os.walk(local_output_dir) for name in names]
+    checksum_paths = sorted(path for path in paths if path.endswith('.sha256'))
+    with ThreadPoolExecutor(max_workers=audit_workers) as executor:
+        verify_log = list(executor.map(verify_part, checksum_paths))
+    if not verify_log:
+        logging.warning(f"No .sha256 files found under {local_output_dir}")
+        return verify_log
+    failed = [record['part_file'] for record in verify_log if not record['verified']]
+    for part_path in failed:
+        logging.error(f"Checksum mismatch: {part_path}")
+    verify_file_path = get_output_path(f"verify_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+    save_log(pd.DataFrame(verify_log), verify_file_path)
+    logging.info(f"Verified {len(verify_log)} parts in {time.perf_counter() - verify_start:.2f}s | {len(failed)} failed")
+    logging.info(f"Verify log saved to: {verify_file_path}")
+    return verify_log
+
+
+def run_profiled(prefix, func, *args):
+    # Only the calling thread is profiled; for read_workers > 1 or a sampling profiler such as py-spy,
+    # attach to the process id logged when the prefix starts instead
+    profile_path = os.path.join(get_state_dir(), f"profile_{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    if profiler == 'pyinstrument':
+        if pyinstrument is None:
+            raise RuntimeError("profiler 'pyinstrument' needs the pyinstrument package installed")
+        sampler = pyinstrument.Profiler()
+        sampler.start()
+        try:
+            return func(*args)
+        finally:
+            sampler.stop()
+            with open(profile_path + '.html', 'w', encoding='utf-8') as f:
+                f.write(sampler.output_html())
+            logging.info(f"Profile of prefix {prefix} saved to: {profile_path}.html")
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        profile.dump_stats(profile_path + '.prof')
+        stats_text = io.StringIO()
+        pstats.Stats(profile, stream=stats_text).sort_stats('cumulative').print_stats(15)
+        logging.info(f"Profile of prefix {prefix} saved to: {profile_path}.prof\n{stats_text.getvalue()}")
+
+
+def run_prefix(prefix, monthly_folders, prefix_matches):
+    if profile_prefix is not None and prefix.lower() == profile_prefix.lower():
+        return run_profiled(prefix, consolidate_prefix, prefix, monthly_folders, prefix_matches)
+    return consolidate_prefix(prefix, monthly_folders, prefix_matches)
+
+
+def consolidate_prefix(prefix, monthly_folders, prefix_matches):
+    # Runs in a worker process when workers > 1, so results are returned instead of appended to shared logs
+    logging.info(f"\n--- Consolidating files for prefix: {prefix} (process {os.getpid()}) ---")
+    prefix_start = time.perf_counter()
+    metadata_log = []
+    prefix_files = []
+    all_columns = set()
+    expected_cols = []
+
+    manifest_state = load_prefix_manifest(prefix) if incremental_runs else None
+    if manifest_state is not None:
+        prefix_matches = stat_matches(prefix_matches)
+    pending_matches, resume = plan_resume(prefix, prefix_matches, manifest_state)
+    if resume is not None and not pending_matches:
+        logging.info(f"No new or changed files for prefix {prefix} since the last run, skipping")
+        return metadata_log, None
+    completed_files = manifest_state['files'] if resume is not None else {}
+
+    # Read headers up front so the output schema is known before the first chunk is written
+    prefix_files, expected_cols, all_columns = plan_prefix_schema(prefix, monthly_folders, prefix_matches, completed_files)
+    col_mismatch_flag = len(all_columns) > 1
+    if resume is not None and expected_cols != manifest_state['columns']:
+        logging.info(f"Columns for prefix {prefix} changed since the last run, rebuilding")
+        resume = None
+    if resume is not None and get_prefix_job(prefix)[1] != manifest_state['filters']:
+        logging.info(f"Row filters for prefix {prefix} changed since the last run, rebuilding")
+        resume = None
+    if resume is not None:
+        prefix_files = [prefix_file for prefix_file in prefix_files if prefix_file['file_path'] not in completed_files]
+    else:
+        completed_files = {}
+    duplicate_files = []
+    if dedup_files:
+        prefix_files, duplicate_files = find_duplicate_files(prefix_files, completed_files)
+    key_columns = get_prefix_setting(dedup_keys, prefix, None)
+    key_set = None
+    if key_columns:
+        # Only rows of this run are compared: an incremental run does not see the keys of earlier runs
+        key_set = RowKeySet(key_columns, os.path.join(get_state_dir(), f"row_keys_{prefix}_{os.getpid()}.sqlite"))
+    key_index_columns = get_index_columns(prefix)
+    if get_prefix_setting(index_columns, prefix, []) and not key_index_columns:
+        logging.warning(f"Key index for prefix {prefix} needs uncompressed CSV or Parquet parts, not building it")
+    prefix_stats = {'total_files': 0, 'total_rows': 0, 'filtered_rows': 0, 'duplicate_rows': 0, 'periods': set(), 'read_seconds': 0.0,
+                    'peak_rss': get_rss_bytes()}
+    stage_times = {'align': 0.0, 'write': 0.0}
+    output_parts = []
+    compactor = ChunkCompactor() if compact_dtypes else None
+
+    try:
+        if dry_run:
+            record_duplicate_files(duplicate_files, metadata_log)
+            for _ in stream_prefix_chunks(prefix_files, metadata_log, prefix_stats, stage_times=stage_times, key_set=key_set,
+                                          compactor=compactor):
+                pass
+        else:
+            manifest_path = get_manifest_path(prefix)
+            if resume is None:
+                output_file = get_output_filename(prefix)
+                append_manifest_record(manifest_path, {
+                    'record_type':'output',
+                    'output_file':output_file,
+                    'columns':expected_cols,
+                    'layout':output_layout,
+                    'filters':get_prefix_job(prefix)[1],
+                    'timestamp':datetime.now()
+                })
+            else:
+                output_file = resume['output_file']
+                logging.info(f"Resuming prefix {prefix} at part {resume['part']} of {output_file}")
+            record_duplicate_files(duplicate_files, metadata_log, manifest_path)
+            output_position = {}
+            chunks = stream_prefix_chunks(prefix_files, metadata_log, prefix_stats, output_position, manifest_path, stage_times,
+                                          key_set, compactor)
+            stats_columns = get_prefix_setting(part_stats_columns, prefix, [])
+            key_index = None
+            if key_index_columns:
+                key_index = KeyIndexWriter(output_file, key_index_columns, resume['index'] if resume is not None else None)
+            output_parts = save_chunks(chunks, output_file, expected_cols, output_position, resume, stage_times, stats_columns,
+                                       key_index)
+            if key_index is not None and output_position:
+                key_index.close(output_position)
+            if output_layout == 'hive' and (output_parts or resume is not None):
+                previous_parts = resume['parts'] if resume is not None else []
+                write_part_manifest(output_file, expected_cols, previous_parts + output_parts, stats_columns)
+    finally:
+        if key_set is not None:
+            key_set.close()
+
+    if prefix_stats['total_rows'] == 0:
+        logging.warning(f"No data found for prefix: {prefix}")
+        return metadata_log, None
+    rows_written = None
+    rows_reconciled = None
+    if dry_run:
+        logging.info(f"Dry run: Skipped saving for prefix {prefix}")
+    else:
+        # Every row read must be in a part unless it was filtered or a duplicate; a file that failed after some of
+        # its rows were written shows up here
+        # A resumed part counts in full, against the rows the manifest recorded for it
+        rows_written = sum(part['rows'] for part in output_parts)
+        rows_expected = sum(record['row_count'] - record['filtered_rows'] - record['duplicate_rows'] for record in metadata_log)
+        rows_expected += sum(part.get('resumed_rows', 0) for part in output_parts)
+        rows_reconciled = rows_written == rows_expected
+        if not rows_reconciled:
+            logging.error(f"Prefix {prefix}: {rows_written} rows written to parts, but the master log accounts for {rows_expected}")
+    prefix_seconds = time.perf_counter() - prefix_start
+    source_bytes = sum(prefix_file['file_size'] for prefix_file in prefix_files)
+    logging.info(f"Prefix {prefix} | {prefix_stats['total_rows']} rows in {prefix_seconds:.2f}s | "
+                 f"{prefix_stats['filtered_rows']} filtered rows | {len(duplicate_files)} duplicate files | "
+                 f"{prefix_stats['duplicate_rows']} duplicate rows | "
+                 f"read {prefix_stats['read_seconds']:.2f}s | align {stage_times['align']:.2f}s | write {stage_times['write']:.2f}s | "
+                 f"{len(output_parts)} parts | peak RSS {to_mb(prefix_stats['peak_rss'])} MB")
+    if compactor is not None and compactor.memory_after:
+        logging.info(f"Prefix {prefix} | chunk memory {to_mb(compactor.memory_before)} MB as read, "
+                     f"{to_mb(compactor.memory_after)} MB compacted ({compactor.memory_before / compactor.memory_after:.1f}x) | "
+                     f"{len(compactor.dtypes)} categorical columns")
+
+    return metadata_log, {
+            'prefix':prefix,
+            'total_files': prefix_stats['total_files'],
+            'total_rows':prefix_stats['total_rows'],
+            'total_cols':len(expected_cols),
+            'column_mismatch_flag':col_mismatch_flag,
+            'start_time': process_start.strftime('%Y-%m-%d %H:%M:%S'),
+            'end_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'periods': ','.join(sorted(prefix_stats['periods'])),
+            'part_count': len(output_parts),
+            'output_bytes': sum(part['file_bytes'] for part in output_parts),
+            'rows_written': rows_written,
+            'rows_reconciled': rows_reconciled,
+            'part_rows': ','.join(f"{get_part_label(part)}:{part['rows']}" for part in output_parts),
+            'part_sha256': ','.join(f"{get_part_label(part)}:{part['sha256']}" for part in output_parts if 'sha256' in part),
+            'part_' + FAST_CHECKSUM: ','.join(f"{get_part_label(part)}:{part[FAST_CHECKSUM]}" for part in output_parts
+                                              if FAST_CHECKSUM in part),
+            # uncompressed / on disk bytes per part written in this run
+            'compression_ratios': ','.join(f"{get_part_label(part)}:{part['data_bytes'] / max(part['file_bytes'], 1):.2f}"
+                                           for part in output_parts),
+            'duplicate_files': len(duplicate_files),
+            'filtered_rows': prefix_stats['filtered_rows'],
+            'duplicate_rows': prefix_stats['duplicate_rows'],
+            'duration_seconds': round(prefix_seconds, 3),
+            'read_seconds': round(prefix_stats['read_seconds'], 3),
+            'align_seconds': round(stage_times['align'], 3),
+            'write_seconds': round(stage_times['write'], 3),
+            'rows_per_sec': round(prefix_stats['total_rows'] / prefix_seconds, 1) if prefix_seconds else None,
+            'bytes_per_sec': round(source_bytes / prefix_seconds, 1) if prefix_seconds else None,
+            'peak_rss_MB': to_mb(prefix_stats['peak_rss'])
+    }
+
+
+def run_prefixes_in_pool(prefixes, monthly_folders, prefix_matches):
+    # Largest prefixes are submitted first so a huge prefix does not end up as the long tail
+    by_size = sorted(range(len(prefixes)), key=lambda i: -sum(match['file_size'] for match in prefix_matches[i]))
+    results = [([], None)] * len(prefixes)
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(applied_options, log_queue, process_start)) as executor:
+            futures = {executor.submit(run_prefix, prefixes[i], monthly_folders, prefix_matches[i]): i
+                       for i in by_size}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    logging.error(f"Error consolidating prefix {prefixes[i]}: {e}")
+    finally:
+        listener.stop()
+    return results
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def get_queue_path(*names):
+    run_name = queue_run or process_start.strftime('%Y%m%d')
+    return os.path.join(queue_dir or os.path.join(get_state_dir(), 'queue'), run_name, *names)
+
+
+def write_queue_file(file_path, record):
+    # Written under a temporary name and renamed, so other workers never read half a file
+    tmp_path = f"{file_path}.{get_worker_id()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, default=str)
+    os.replace(tmp_path, file_path)
+
+
+def read_queue_file(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def is_lease_stale(lease_path):
+    try:
+        return time.time() - os.stat(lease_path).st_mtime > lease_seconds
+    except FileNotFoundError:
+        return False
+
+
+def steal_lease(lease_path):
+    # Renaming is atomic, so of several workers finding the same stale lease only one moves it away.
+    # If the lease was renewed between the check and the rename it is linked back (link fails if a new lease exists).
+    stolen_path = f"{lease_path}.{get_worker_id()}.stolen"
+    try:
+        os.rename(lease_path, stolen_path)
+    except FileNotFoundError:
+        return False
+    if time.time() - os.stat(stolen_path).st_mtime <= lease_seconds:
+        try:
+            os.link(stolen_path, lease_path)
+        except OSError:
+            pass
+        os.remove(stolen_path)
+        return False
+    try:
+        holder = read_queue_file(stolen_path)['worker']
+    except (OSError, ValueError, KeyError):
+        holder = 'unknown'
+    logging.warning(f"Taking over the stale lease of {holder}: {lease_path}")
+    os.remove(stolen_path)
+    return True
+
+
+def claim_prefix(prefix):
+    # Returns the lease path once this worker holds the prefix, None when it is done, failed or held by a live worker
+    if os.path.exists(get_queue_path(f"{prefix}.done")) or os.path.exists(get_queue_path(f"{prefix}.failed")):
+        return None
+    lease_path = get_queue_path(f"{prefix}.lease")
+    for _ in range(2):
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if not is_lease_stale(lease_path) or not steal_lease(lease_path):
+                return None
+    else:
+        return None
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump({'worker': get_worker_id(), 'claimed': datetime.now()}, f, default=str)
+    if os.path.exists(get_queue_path(f"{prefix}.done")):
+        os.remove(lease_path)  # finished by the worker whose lease was renamed away just as it completed
+        return None
+    with open(get_queue_path(f"{prefix}.attempts"), 'a', encoding='utf-8') as f:
+        f.write(f"{get_worker_id()} {datetime.now()}\n")
+    with open(get_queue_path(f"{prefix}.attempts"), 'r', encoding='utf-8') as f:
+        attempts = sum(1 for _ in f)
+    if attempts > queue_max_attempts:
+        logging.error(f"Prefix {prefix} was claimed {attempts - 1} times without finishing, marking it failed")
+        write_queue_file(get_queue_path(f"{prefix}.failed"), {'worker': get_worker_id(), 'attempts': attempts - 1})
+        os.remove(lease_path)
+        return None
+    return lease_path
+
+
+class LeaseHeartbeat:
+    # Touches the lease every third of lease_seconds while the prefix is consolidated, so other workers see it is alive
+    def __init__(self, lease_path):
+        self.lease_path = lease_path
+        self.lost = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(lease_seconds / 3):
+            try:
+                os.utime(self.lease_path)
+                self.lost = read_queue_file(self.lease_path)['worker'] != get_worker_id()
+            except (OSError, ValueError):
+                self.lost = True
+            if self.lost:
+                logging.error(f"Lost the lease {self.lease_path} to another worker")
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+
+MANIFEST_ONLY_KEYS = ('record_type', 'file_size_bytes', 'file_mtime', 'dialect', 'columns', 'output_parts', 'output_end')
+
+
+def recover_taken_over_records(prefix, file_records, prefix_record):
+    # A worker that took a prefix over only consolidated the files its predecessors had not finished. Their files are
+    # in the run manifest, recorded into the output the prefix ended with since the first claim in this queue run,
+    # and go back into the master log rows and summary totals of the prefix.
+    with open(get_queue_path(f"{prefix}.attempts"), 'r', encoding='utf-8') as f:
+        claims = [line.split(' ', 1)[1].strip() for line in f if line.strip()]
+    manifest_state = load_prefix_manifest(prefix)
+    if len(claims) < 2 or manifest_state is None:
+        return file_records, prefix_record
+    first_claim = datetime.fromisoformat(claims[0])
+    recorded = {record['file_location'] for record in file_records}
+    recovered = [{key: value for key, value in record.items() if key not in MANIFEST_ONLY_KEYS}
+                 for record in manifest_state['files'].values()
+                 if record['file_location'] not in recorded and datetime.fromisoformat(record['timestamp']) >= first_claim]
+    if not recovered:
+        return file_records, prefix_record
+    logging.info(f"Prefix {prefix} was taken over, {len(recovered)} files recorded by earlier holders are merged from its manifest")
+    if prefix_record is None:
+        prefix_record = {'prefix': prefix, 'total_files': 0, 'total_rows': 0, 'periods': '', 'duplicate_files': 0,
+                         'filtered_rows': 0, 'duplicate_rows': 0}
+    prefix_record = dict(prefix_record)
+    written = [record for record in recovered if record['duplicate_of'] is None]
+    prefix_record['total_files'] += len(written)
+    prefix_record['duplicate_files'] += len(recovered) - len(written)
+    for key, column in (('total_rows', 'row_count'), ('filtered_rows', 'filtered_rows'), ('duplicate_rows', 'duplicate_rows')):
+        prefix_record[key] += sum(record[column] for record in written)
+    periods = set(filter(None, prefix_record['periods'].split(','))) | {str(record['month']) for record in written}
+    prefix_record['periods'] = ','.join(sorted(periods))
+    return recovered + file_records, prefix_record
+
+
+def run_prefix_queue(prefixes, monthly_folders, prefix_matches):
+    # Claims prefixes one at a time through lease files in the shared queue folder; any number of workers on any
+    # number of hosts can run this against the same output dir. A worker that dies stops heartbeating and its
+    # prefix is taken over and resumed from the manifest. Workers wait until every prefix is done or failed;
+    # the one that then claims the merge returns all workers' results, the others return None.
+    # Results of a taken over prefix are completed from its manifest.
+    apply_options({'incremental_runs': True})  # a taken over prefix continues from what the previous holder completed
+    os.makedirs(get_queue_path(), exist_ok=True)
+    by_size = sorted(range(len(prefixes)), key=lambda i: -sum(match['file_size'] for match in prefix_matches[i]))
+    logging.info(f"Queue worker {get_worker_id()} on {get_queue_path()}")
+    while True:
+        claimed = False
+        for i in by_size:
+            lease_path = claim_prefix(prefixes[i])
+            if lease_path is None:
+                continue
+            claimed = True
+            logging.info(f"Claimed prefix {prefixes[i]}")
+            try:
+                with LeaseHeartbeat(lease_path) as heartbeat:
+                    file_records, prefix_record = run_prefix(prefixes[i], monthly_folders, prefix_matches[i])
+            except Exception as e:
+                logging.error(f"Error consolidating prefix {prefixes[i]}: {e}")
+                if not heartbeat.lost:
+                    os.remove(lease_path)  # released for a retry
+                continue
+            if heartbeat.lost:
+                continue  # the worker that took the lease over records the prefix
+            write_queue_file(get_queue_path(f"{prefixes[i]}.done"), {'worker': get_worker_id(), 'file_records': file_records,
+                                                                     'prefix_record': prefix_record})
+            os.remove(lease_path)
+        finished = [os.path.exists(get_queue_path(f"{prefix}.done")) or os.path.exists(get_queue_path(f"{prefix}.failed"))
+                    for prefix in prefixes]
+        if all(finished):
+            break
+        if not claimed:
+            time.sleep(min(lease_seconds / 3, 10))  # others are still working; wait in case a lease goes stale
+
+    try:
+        os.close(os.open(get_queue_path('merge.lease'), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        logging.info(f"All prefixes of queue run {get_queue_path()} are finished, another worker merges the logs")
+        return None
+    results = []
+    for prefix in prefixes:
+        done_path = get_queue_path(f"{prefix}.done")
+        if os.path.exists(done_path):
+            record = read_queue_file(done_path)
+            results.append(recover_taken_over_records(prefix, record['file_records'], record['prefix_record']))
+        else:
+            logging.error(f"Prefix {prefix} failed in queue run {get_queue_path()}")
+    logging.info(f"Merging the logs of {len(results)} prefixes from the queue")
+    return results
+
+
+def write_metrics(run_record, prefix_records, file_records):
+    # Prometheus: one textfile per run, replaced whole so the node exporter never reads half a file.
+    # JSON lines: run, prefix and file records appended per run, for graphing across nightly runs.
+    os.makedirs(get_state_dir(), exist_ok=True)
+    if metrics_format == 'jsonl':
+        metrics_path = os.path.join(get_state_dir(), 'metrics.jsonl')
+        with open(metrics_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(run_record, record_type='run'), default=str) + '\n')
+            for record in prefix_records:
+                f.write(json.dumps(dict(record, record_type='prefix', run_start=run_record['run_start']), default=str) + '\n')
+            for record in file_records:
+                f.write(json.dumps(dict(record, record_type='file', run_start=run_record['run_start']), default=str) + '\n')
+    elif metrics_format == 'prometheus':
+        metrics_path = os.path.join(get_state_dir(), 'archival_metrics.prom')
+        lines = [
+            f"archival_run_timestamp_seconds {run_record['run_timestamp']}",
+            f"archival_run_duration_seconds {run_record['duration_seconds']}",
+            f"archival_list_duration_seconds {run_record['list_seconds']}",
+            f"archival_run_rows {run_record['total_rows']}",
+        ]
+        prefix_metrics = [
+            ('archival_prefix_rows', 'total_rows'),
+            ('archival_prefix_files', 'total_files'),
+            ('archival_prefix_parts', 'part_count'),
+            ('archival_prefix_output_bytes', 'output_bytes'),
+            ('archival_prefix_duration_seconds', 'duration_seconds'),
+            ('archival_prefix_rows_per_second', 'rows_per_sec'),
+            ('archival_prefix_bytes_per_second', 'bytes_per_sec'),
+            ('archival_prefix_peak_rss_megabytes', 'peak_rss_MB'),
+        ]
+        for metric, field in prefix_metrics:
+            for record in prefix_records:
+                if record.get(field) is not None:
+                    lines.append(f'{metric}{{prefix="{record["prefix"]}"}} {record[field]}')
+        for record in prefix_records:
+            for stage in ('read', 'align', 'write'):
+                lines.append(f'archival_prefix_stage_seconds{{prefix="{record["prefix"]}",stage="{stage}"}} {record[stage + "_seconds"]}')
+        tmp_path = metrics_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, metrics_path)
+    else:
+        return
+    logging.info(f"Metrics saved to: {metrics_path}")
+
+
+def consolidate_files(listing=None):
+    # listing, when given, is the (prefixes, monthly folders, source index) a watch mode poll already built
+    start = datetime.now()
+    list_start = time.perf_counter()
+    if listing is None:
+        prefixes = read_prefix_sheet(local_prefix_file)
+        monthly_folders = list_monthly_folders(local_source_prefix)
+        index_file_path = os.path.join(get_state_dir(), 'source_index.json') if save_source_index else None
+        source_index = build_source_index(monthly_folders, index_file_path)
+    else:
+        prefixes, monthly_folders, source_index = listing
+    prefix_matches = [find_prefix_files(source_index, prefix) for prefix in prefixes]
+    list_seconds = time.perf_counter() - list_start
+    logging.info(f"Listed {len(source_index['entries'])} source files in {list_seconds:.2f}s")
+    metadata_log = []
+    master_metadata_log = []
+
+    if schema_report_only:
+        write_schema_report(prefixes, monthly_folders, prefix_matches)
+        return
+    if audit_only:
+        write_audit_log(prefixes, monthly_folders, prefix_matches)
+        return
+    
+    if queue_mode:
+        results = run_prefix_queue(prefixes, monthly_folders, prefix_matches)
+        if results is None:
+            return
+    elif workers > 1:
+        results = run_prefixes_in_pool(prefixes, monthly_folders, prefix_matches)
+    else:
+        results = (run_prefix(prefix, monthly_folders, matches)
+                   for prefix, matches in zip(prefixes, prefix_matches))
+
+    # Logs are written in prefix sheet order whatever order the prefixes finished in
+    for file_records, prefix_record in results:
+        metadata_log.extend(file_records)
+        if prefix_record is not None:
+            master_metadata_log.append(prefix_record)
+
+    if metadata_log:
+        master_df = pd.DataFrame(metadata_log)
+        master_file_path = get_output_path(f"master_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        save_log(master_df, master_file_path)
+        logging.info(f"Master log saved to: {master_file_path}")
+    else:
+        logging.warning("No file information to save in master log")
+        
+    if master_metadata_log:
+        summary_df = pd.DataFrame(master_metadata_log)
+        summary_file_path = get_output_path(f"summary_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
+        save_log(summary_df, summary_file_path)
+        logging.info(f"Summary log saved to : {summary_file_path}")
+    else:
+        logging.warning("No summary information to save")
+
+    if metrics_format:
+        end = datetime.now()
+        write_metrics({
+            'run_start': start,
+            'run_timestamp': int(end.timestamp()),
+            'duration_seconds': round((end - start).total_seconds(), 3),
+            'list_seconds': round(list_seconds, 3),
+            'total_rows': sum(record['total_rows'] for record in master_metadata_log),
+            'peak_rss_MB': max((record['peak_rss_MB'] for record in master_metadata_log
+                                if record['peak_rss_MB'] is not None), default=None)
+        }, master_metadata_log, metadata_log)
+        
+
+
+
+def get_settled_entries(source_index, settle_seconds, prefixes):
+    # Source index entries unchanged for settle_seconds. Local files matched by a prefix are stat'ed again on every
+    # poll, as appending to or overwriting a file does not change its folder mtime, so the cached listing would keep
+    # its old size and mtime for good. Their fresh size and mtime go back into the cached listing.
+    now = time.time_ns()
+    matched = {match['file_path'] for prefix in prefixes for match in find_prefix_files(source_index, prefix)}
+    settled = []
+    for entry in source_index['entries']:
+        name, period, file_path, size, mtime = entry
+        if file_path in matched and not is_s3_path(file_path):
+            try:
+                file_stats = os.stat(file_path)
+            except OSError:
+                continue  # removed again since it was listed
+            size, mtime = file_stats.st_size, file_stats.st_mtime_ns
+            cached_entry = source_index['folders'].get(os.path.dirname(file_path))
+            for cached_file in cached_entry['files'] if cached_entry else []:
+                if cached_file[0] == os.path.basename(file_path):
+                    cached_file[1], cached_file[2] = size, mtime
+        if not is_s3_path(file_path) and now - mtime < settle_seconds * 1_000_000_000:
+            continue  # S3 objects only appear once their upload is complete
+        settled.append((name, period, file_path, size, mtime))
+    return settled
+
+
+def watch_source():
+    # Long running mode: imports, the prefix sheet and the folder listing stay in memory between polls. A poll
+    # re-lists only folders whose mtime changed and consolidates only the prefixes with new or changed files,
+    # each resumed from its manifest so the new rows go into its current part.
+    apply_options({'incremental_runs': True})  # through applied_options, so pool workers resume too
+    prefixes = None
+    sheet_mtime = None
+    cached_folders = None
+    known_files = None  # (size, mtime) per file path of the files consolidated so far
+    poll = 0
+    logging.info(f"Watching {local_source_prefix} every {watch_interval}s")
+    try:
+        while watch_polls is None or poll < watch_polls:
+            if poll:
+                time.sleep(watch_interval)
+            poll += 1
+            poll_start = time.perf_counter()
+            current_sheet_mtime = os.stat(local_prefix_file).st_mtime_ns
+            sheet_changed = current_sheet_mtime != sheet_mtime
+            if sheet_changed:
+                prefixes = read_prefix_sheet(local_prefix_file)
+                sheet_mtime = current_sheet_mtime
+                logging.info(f"Read {len(prefixes)} prefixes from {local_prefix_file}")
+            monthly_folders = list_monthly_folders(local_source_prefix)
+            source_index = build_source_index(monthly_folders, cached_folders=cached_folders)
+            cached_folders = source_index['folders']
+            entries = get_settled_entries(source_index, watch_settle_seconds, prefixes)
+            settled_index = {'keys': [entry[0] for entry in entries], 'entries': entries}
+            changed_files = {file_path for _, _, file_path, size, mtime in entries
+                             if known_files is None or known_files.get(file_path) != (size, mtime)}
+            known_files = {file_path: (size, mtime) for _, _, file_path, size, mtime in entries}
+            if sheet_changed:
+                run_prefixes = prefixes  # a prefix new to the sheet has no manifest yet, whatever its files
+            else:
+                run_prefixes = [prefix for prefix in prefixes
+                                if any(match['file_path'] in changed_files for match in find_prefix_files(settled_index, prefix))]
+            if run_prefixes:
+                consolidate_files((run_prefixes, monthly_folders, settled_index))
+            logging.info(f"Poll {poll} | {len(changed_files)} new or changed files | {len(run_prefixes)} prefixes consolidated | "
+                         f"{len(source_index['entries']) - len(entries)} files settling | {time.perf_counter() - poll_start:.2f}s")
+    except KeyboardInterrupt:
+        logging.info("Watch mode stopped")
+
+
+# ---------- Run ----------
+if __name__ == '__main__':
+    options = vars(parse_args())
+    apply_options(options)
+    # clear terminal
+    os.system('cls' if os.name == 'nt' else 'clear')
+    setup_logging()
+    process_start = datetime.now()
+    start = datetime.now() 
+    exit_code = 0
+    if lookup_keys:
+        if run_lookup() is None:
+            exit_code = 1
+    elif verify_only:
+        verify_part_checksums()
+    elif watch_mode:
+        watch_source()
+    else:
+        consolidate_files()
+    end = datetime.now()
+    logging.info(f"Total execution time: {end - start}")   
+    logging.info("-------------Program Completed-----------------")
+    sys.exit(exit_code)